@@ -3,62 +3,199 @@
 import logging
 import re
 import asyncio
-from datetime import datetime, timedelta
+import time
+import weakref
+from collections import OrderedDict
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
 from telegram.ext import ContextTypes
 
 from config import (
     WELCOME_MESSAGE, PHRASE_REQUEST_MESSAGE, PHRASE_THANKS_MESSAGE,
-    MAX_MESSAGE_LENGTH, MESSAGE_COOLDOWN, STOP_WORDS, ADMIN_ID
+    MAX_MESSAGE_LENGTH, MESSAGE_COOLDOWN, STOP_WORDS
 )
 from database_optimized import optimized_db
-from security import security_manager
+from security import security_manager, admin_only
+from moderation_system import phrase_quality_bitmask
+
+try:
+    import ahocorasick  # pyahocorasick, опционально
+except ImportError:
+    ahocorasick = None
 
 logger = logging.getLogger(__name__)
 
+# Состояния пользователя
+STATE_MAIN_MENU = 0
+STATE_WAITING_PHRASE = 1
+
+# Сессии пользователей: user_id -> (состояние, время последней фразы по time.monotonic())
+_NO_COOLDOWN = float('-inf')
+_DEFAULT_SESSION = (STATE_MAIN_MENU, _NO_COOLDOWN)
+
 # Глобальные переменные
-user_states = {}
-user_cooldowns = {}
+user_sessions = OrderedDict()  # порядок = давность последнего изменения (LRU)
 global_scheduler = None
 
+# Живое множество заблокированных из security_manager (меняется на месте)
+_blocked_users = security_manager.blocked_users
+
+# Методы security_manager, вызываемые на каждое сообщение, связываем один раз
+_check_rate_limit = security_manager.check_rate_limit
+_log_user_action = security_manager.log_user_action
+
+# Блокировки на пользователя; освобождаются сборщиком мусора, когда не используются
+_user_locks = weakref.WeakValueDictionary()
+
+# Периодическая очистка устаревших состояний и cooldown
+USER_DATA_GC_INTERVAL = 300  # секунд
+_last_gc_time = 0.0
+
+# Жесткий предел числа сессий: самые старые вытесняются
+MAX_USER_SESSIONS = 100_000
+
 # Кнопки интерфейса
 BUTTON_GET_PHRASE = "💌 Получить сообщение"
 BUTTON_SHARE_PHRASE = "🌱 Поделиться своим"
 
+def _normalize_stop_words(words) -> tuple:
+    """Приводим стоп-слова к нижнему регистру и убираем лишние.
+    
+    Поиск идет по подстрокам, поэтому слово, содержащее другое стоп-слово,
+    ничего не добавляет и отбрасывается вместе с дублями.
+    """
+    unique_words = sorted(frozenset(word.lower() for word in words if word), key=lambda w: (len(w), w))
+    
+    result = []
+    for word in unique_words:
+        if not any(shorter in word for shorter in result):
+            result.append(word)
+    return tuple(result)
+
+# Нормализуются один раз при импорте модуля
+_STOP_WORDS_LOWER = _normalize_stop_words(STOP_WORDS)
+
+def _build_stop_words_automaton():
+    """Строим автомат Ахо-Корасик по стоп-словам (один проход по тексту)"""
+    if ahocorasick is None:
+        return None
+    
+    automaton = ahocorasick.Automaton()
+    for stop_word in _STOP_WORDS_LOWER:
+        automaton.add_word(stop_word, stop_word)
+    automaton.make_automaton()
+    return automaton
+
+# Строится один раз при импорте модуля
+_STOP_WORDS_AUTOMATON = _build_stop_words_automaton()
+
+# Стоп-слова одной альтернативой для запасной регулярки без pyahocorasick.
+# Длинные слова первыми, чтобы в лог попадало самое полное совпадение.
+# Пустая альтернатива совпала бы с любой строкой - подставляем (?!)
+_STOP_WORDS_PATTERN = '|'.join(
+    re.escape(word) for word in sorted(_STOP_WORDS_LOWER, key=len, reverse=True)
+) or '(?!)'
+
+# Регулярка для поиска ссылок (компилируется один раз).
+# re.ASCII: \w ищет только латиницу и цифры - домены в ссылках ASCII
+_URL_RE = re.compile(r'https?://|www\.|\w+\.\w+', re.ASCII)
+
+# Нарушения в тексте фразы
+VIOLATION_STOP_WORD = 'stop_word'
+VIOLATION_URL = 'url'
+
+def _build_phrase_filter_re():
+    """Одна регулярка для стоп-слов и ссылок: тип нарушения по имени группы"""
+    return re.compile(
+        f'(?P<{VIOLATION_STOP_WORD}>{_STOP_WORDS_PATTERN})|(?P<{VIOLATION_URL}>{_URL_RE.pattern})',
+        re.ASCII
+    )
+
+# Используется, когда нет pyahocorasick: проверка фразы за один проход
+_PHRASE_FILTER_RE = _build_phrase_filter_re()
+
 def set_global_scheduler(scheduler):
     """Устанавливаем глобальный планировщик"""
     global global_scheduler
     global_scheduler = scheduler
     logger.info("✅ Оптимизированный планировщик установлен")
 
-def get_main_keyboard():
-    """Создаем главную клавиатуру"""
-    keyboard = [
+# Общие ответы админских команд
+_SCHEDULER_NOT_READY_MESSAGE = "❌ Планировщик не инициализирован"
+
+# Главная клавиатура неизменна - создаем один раз
+_MAIN_KEYBOARD = ReplyKeyboardMarkup(
+    [
         [KeyboardButton(BUTTON_GET_PHRASE)],
         [KeyboardButton(BUTTON_SHARE_PHRASE)]
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    ],
+    resize_keyboard=True
+)
+
+def get_main_keyboard():
+    """Возвращаем главную клавиатуру"""
+    return _MAIN_KEYBOARD
+
+def get_user_state(user_id: int) -> int:
+    """Получаем состояние пользователя"""
+    return user_sessions.get(user_id, _DEFAULT_SESSION)[0]
+
+def _store_session(user_id: int, session: tuple):
+    """Сохраняем сессию и вытесняем самые старые сверх лимита"""
+    user_sessions[user_id] = session
+    user_sessions.move_to_end(user_id)
+    if len(user_sessions) > MAX_USER_SESSIONS:
+        user_sessions.popitem(last=False)
+
+def set_user_state(user_id: int, state: int):
+    """Устанавливаем состояние, сохраняя cooldown"""
+    _store_session(user_id, (state, user_sessions.get(user_id, _DEFAULT_SESSION)[1]))
+
+def cooldown_remaining(user_id: int) -> float:
+    """Сколько секунд осталось до конца cooldown (0, если его нет)"""
+    last_time = user_sessions.get(user_id, _DEFAULT_SESSION)[1]
+    return max(0.0, MESSAGE_COOLDOWN - (time.monotonic() - last_time))
 
 def is_on_cooldown(user_id: int) -> bool:
     """Проверяем cooldown пользователя"""
-    if user_id not in user_cooldowns:
-        return False
-    
-    time_passed = datetime.now() - user_cooldowns[user_id]
-    return time_passed.total_seconds() < MESSAGE_COOLDOWN
+    return cooldown_remaining(user_id) > 0
 
 def set_cooldown(user_id: int):
-    """Устанавливаем cooldown"""
-    user_cooldowns[user_id] = datetime.now()
-
-def contains_stop_words(text: str) -> bool:
-    """Проверяем стоп-слова"""
-    text_lower = text.lower()
-    for stop_word in STOP_WORDS:
-        if stop_word in text_lower:
-            logger.warning(f"🚫 Стоп-слово '{stop_word}' в тексте")
-            return True
-    return False
+    """Устанавливаем cooldown, сохраняя состояние"""
+    _store_session(user_id, (user_sessions.get(user_id, _DEFAULT_SESSION)[0], time.monotonic()))
+
+def get_user_lock(user_id: int) -> asyncio.Lock:
+    """Получаем блокировку пользователя для изменения его сессии"""
+    lock = _user_locks.get(user_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _user_locks[user_id] = lock
+    return lock
+
+def cleanup_user_data():
+    """Удаляем сессии в главном меню с истекшим cooldown"""
+    global _last_gc_time
+    
+    now = time.monotonic()
+    if now - _last_gc_time < USER_DATA_GC_INTERVAL:
+        return
+    _last_gc_time = now
+    
+    for user_id, (state, last_time) in list(user_sessions.items()):
+        if state == STATE_MAIN_MENU and now - last_time >= MESSAGE_COOLDOWN:
+            del user_sessions[user_id]
+
+def find_phrase_violation(text_lower: str):
+    """Ищем стоп-слово или ссылку; возвращаем (тип нарушения, фрагмент) или None"""
+    if _STOP_WORDS_AUTOMATON is not None:
+        match = next(_STOP_WORDS_AUTOMATON.iter(text_lower), None)
+        if match is not None:
+            return VIOLATION_STOP_WORD, match[1]
+        
+        match = _URL_RE.search(text_lower)
+        return (VIOLATION_URL, match.group()) if match else None
+    
+    match = _PHRASE_FILTER_RE.search(text_lower)
+    return (match.lastgroup, match.group()) if match else None
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Оптимизированный обработчик /start"""
@@ -66,18 +203,16 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = user.id
     username = user.first_name or "Пользователь"
     
-    logger.info(f"👤 {username} (ID: {user_id}) запустил /start")
-    
-    # Асинхронно добавляем пользователя и получаем фразу
-    add_user_task = optimized_db.add_user(user_id, username)
-    get_phrase_task = optimized_db.get_random_phrase()
+    logger.info("👤 %s (ID: %s) запустил /start", username, user_id)
     
-    # Ждем выполнения обеих операций параллельно
-    await add_user_task
-    phrase = await get_phrase_task
+    # Добавляем пользователя и получаем фразу параллельно
+    _, phrase = await asyncio.gather(
+        optimized_db.add_user(user_id, username),
+        optimized_db.get_random_phrase()
+    )
     
     # Сбрасываем состояние
-    user_states[user_id] = "main_menu"
+    set_user_state(user_id, STATE_MAIN_MENU)
     
     # Отправляем фразу и кнопки
     await update.message.reply_text(phrase)
@@ -86,7 +221,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=get_main_keyboard()
     )
     
-    logger.info(f"✅ Приветствие отправлено {username}")
+    logger.info("✅ Приветствие отправлено %s", username)
 
 async def get_warmth_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Оптимизированный обработчик получения фразы"""
@@ -94,7 +229,7 @@ async def get_warmth_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user_id = user.id
     username = user.first_name or "Пользователь"
     
-    logger.info(f"✨ {username} (ID: {user_id}) запросил фразу")
+    logger.info("✨ %s (ID: %s) запросил фразу", username, user_id)
     
     # Асинхронно получаем фразу из кэша или БД
     phrase = await optimized_db.get_random_phrase()
@@ -105,7 +240,7 @@ async def get_warmth_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         reply_markup=get_main_keyboard()
     )
     
-    logger.info(f"✅ Фраза отправлена {username}")
+    logger.info("✅ Фраза отправлена %s", username)
 
 async def share_phrase_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Оптимизированный обработчик поделиться фразой"""
@@ -113,11 +248,11 @@ async def share_phrase_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     user_id = user.id
     username = user.first_name or "Пользователь"
     
-    logger.info(f"💝 {username} (ID: {user_id}) хочет поделиться")
+    logger.info("💝 %s (ID: %s) хочет поделиться", username, user_id)
     
     # Проверяем cooldown
-    if is_on_cooldown(user_id):
-        remaining_time = MESSAGE_COOLDOWN - (datetime.now() - user_cooldowns[user_id]).total_seconds()
+    remaining_time = cooldown_remaining(user_id)
+    if remaining_time:
         remaining_minutes = int(remaining_time // 60)
         
         await update.message.reply_text(
@@ -125,18 +260,24 @@ async def share_phrase_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             reply_markup=get_main_keyboard()
         )
         
-        logger.info(f"⏰ {username} на cooldown")
+        logger.info("⏰ %s на cooldown", username)
         return
     
     # Устанавливаем состояние ожидания
-    user_states[user_id] = "waiting_phrase"
+    set_user_state(user_id, STATE_WAITING_PHRASE)
     
     await update.message.reply_text(
         PHRASE_REQUEST_MESSAGE,
         reply_markup=get_main_keyboard()
     )
     
-    logger.info(f"✅ Запросили фразу у {username}")
+    logger.info("✅ Запросили фразу у %s", username)
+
+# Обработчики кнопок: текст кнопки -> обработчик
+_BUTTON_HANDLERS = {
+    BUTTON_GET_PHRASE: get_warmth_handler,
+    BUTTON_SHARE_PHRASE: share_phrase_handler,
+}
 
 async def text_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Оптимизированный обработчик текстовых сообщений"""
@@ -145,38 +286,35 @@ async def text_message_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     username = user.first_name or "Пользователь"
     message_text = update.message.text
     
+    # Периодически чистим словари, чтобы они не росли бесконечно
+    cleanup_user_data()
+    
     # Проверки безопасности (быстрые, неблокирующие)
-    if security_manager.is_user_blocked(user_id):
-        logger.warning(f"🚫 Заблокированный пользователь {user_id}")
+    if user_id in _blocked_users:
+        logger.warning("🚫 Заблокированный пользователь %s", user_id)
         return
     
-    if not security_manager.check_rate_limit(user_id, 'message'):
+    # Обработка кнопок (мгновенная обработка).
+    # Кнопки не проходят rate limit: отправку фраз и так ограничивает cooldown
+    button_handler = _BUTTON_HANDLERS.get(message_text)
+    if button_handler is not None:
+        await button_handler(update, context)
+        return
+    
+    if not _check_rate_limit(user_id, 'message'):
         await update.message.reply_text(
             "⏰ Вы отправляете сообщения слишком часто."
         )
-        logger.warning(f"⚠️ {username} превысил лимит")
+        logger.warning("⚠️ %s превысил лимит", username)
         return
     
     # Логируем действие (неблокирующая операция)
-    security_manager.log_user_action(user_id, 'message', message_text)
-    
-    logger.info(f"💬 {username}: '{message_text[:50]}...'")
-    
-    # Проверяем состояние
-    if user_id not in user_states:
-        user_states[user_id] = "main_menu"
+    _log_user_action(user_id, 'message', message_text)
     
-    current_state = user_states[user_id]
+    logger.info("💬 %s: '%.50s...'", username, message_text)
     
-    # Обработка кнопок (мгновенная обработка)
-    if message_text == BUTTON_GET_PHRASE:
-        await get_warmth_handler(update, context)
-        
-    elif message_text == BUTTON_SHARE_PHRASE:
-        await share_phrase_handler(update, context)
-        
     # Обработка ввода фразы
-    elif current_state == "waiting_phrase":
+    if get_user_state(user_id) == STATE_WAITING_PHRASE:
         await process_user_phrase(update, context, message_text, user_id, username)
         
     else:
@@ -189,6 +327,16 @@ async def text_message_handler(update: Update, context: ContextTypes.DEFAULT_TYP
 async def process_user_phrase(update: Update, context: ContextTypes.DEFAULT_TYPE, 
                             phrase: str, user_id: int, username: str):
     """Оптимизированная обработка пользовательской фразы"""
+    async with get_user_lock(user_id):
+        # Пока ждали блокировку, предыдущее сообщение могло уже сменить состояние
+        if get_user_state(user_id) != STATE_WAITING_PHRASE:
+            return
+        
+        await _process_user_phrase_locked(update, context, phrase, user_id, username)
+
+async def _process_user_phrase_locked(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                      phrase: str, user_id: int, username: str):
+    """Проверяем и сохраняем фразу (вызывается под блокировкой пользователя)"""
     
     # Быстрые синхронные проверки сначала
     if len(phrase) > MAX_MESSAGE_LENGTH:
@@ -198,22 +346,19 @@ async def process_user_phrase(update: Update, context: ContextTypes.DEFAULT_TYPE
         )
         return
     
-    # Проверка стоп-слов (быстрая)
-    if contains_stop_words(phrase):
-        await update.message.reply_text(
-            "😔 Фраза содержит неподходящие слова. Попробуйте что-то позитивное.",
-            reply_markup=get_main_keyboard()
-        )
-        user_states[user_id] = "main_menu"
-        return
+    # Стоп-слова и ссылки - один проход по тексту в нижнем регистре
+    violation = find_phrase_violation(phrase.lower())
     
-    # Проверка ссылок (быстрая)
-    if re.search(r'http[s]?://|www\.|\w+\.\w+', phrase):
-        await update.message.reply_text(
-            "🔗 Фразы не должны содержать ссылки.",
-            reply_markup=get_main_keyboard()
-        )
-        user_states[user_id] = "main_menu"
+    if violation is not None:
+        violation_type, fragment = violation
+        if violation_type == VIOLATION_STOP_WORD:
+            logger.warning("🚫 Стоп-слово '%s' в тексте", fragment)
+            reply = "😔 Фраза содержит неподходящие слова. Попробуйте что-то позитивное."
+        else:
+            reply = "🔗 Фразы не должны содержать ссылки."
+        
+        await update.message.reply_text(reply, reply_markup=get_main_keyboard())
+        set_user_state(user_id, STATE_MAIN_MENU)
         return
     
     # Автоматическая модерация через систему безопасности
@@ -229,18 +374,20 @@ async def process_user_phrase(update: Update, context: ContextTypes.DEFAULT_TYPE
         if moderation_result.get('auto_block'):
             security_manager.block_user(user_id, moderation_result['reason'])
         
-        user_states[user_id] = "main_menu"
+        set_user_state(user_id, STATE_MAIN_MENU)
         return
     
     # Асинхронно сохраняем фразу в БД
-    success = await optimized_db.save_user_phrase(user_id, username, phrase)
+    success = await optimized_db.save_user_phrase(
+        user_id, username, phrase, phrase_quality_bitmask(phrase)
+    )
     
     if success:
         await update.message.reply_text(
             PHRASE_THANKS_MESSAGE,
             reply_markup=get_main_keyboard()
         )
-        logger.info(f"✅ Фраза сохранена от {username}")
+        logger.info("✅ Фраза сохранена от %s", username)
         
         # Устанавливаем cooldown
         set_cooldown(user_id)
@@ -250,25 +397,52 @@ async def process_user_phrase(update: Update, context: ContextTypes.DEFAULT_TYPE
             "😔 Произошла ошибка при сохранении.",
             reply_markup=get_main_keyboard()
         )
-        logger.error(f"❌ Ошибка сохранения от {username}")
+        logger.error("❌ Ошибка сохранения от %s", username)
     
     # Сбрасываем состояние
-    user_states[user_id] = "main_menu"
+    set_user_state(user_id, STATE_MAIN_MENU)
+
+# Шаблон админской статистики (разбирается один раз при импорте)
+_ADMIN_STATS_TEMPLATE = """👑 **ОПТИМИЗИРОВАННАЯ СТАТИСТИКА**
+
+📊 **База данных (SQLite):**
+👥 Активных пользователей: {active_users}
+👤 Всего пользователей: {total_users}
+🌞 Активных фраз: {active_phrases}
+⏳ На модерации: {pending_phrases}
+📈 Уведомлений за 24ч: {notifications_24h}
+❌ Неудачных отправок: {failed_notifications}
+💾 Кэш фраз: {cache_size}
 
-# Замените функцию admin_stats_command в bot_handlers_optimized.py
-# Строки примерно 250-310
+🔔 **Планировщик (Батчинг):**
+📤 Всего рассылок: {total_notifications}
+✅ Отправлено: {total_sent}
+❌ Ошибок: {total_failed}
+⏱️ Время последней рассылки: {batch_time}
+📦 Размер батча: {batch_size}
+▶️ Статус: {scheduler_status}
+📡 Отправляет сейчас: {is_sending}
+
+🛡️ **Безопасность:**
+🚫 Заблокированных: {blocked_users}
+👁️ Отслеживается: {active_users_tracked}
 
-async def admin_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+🚀 **Производительность:**
+Поддержка: 10,000+ пользователей
+Скорость: 1000+ сообщений/минуту
+Тип БД: SQLite с WAL режимом
+
+🔧 **Команды:**
+/admin - эта статистика
+/test_notification - тест рассылки админу
+/test_soon - тест через 1 минуту
+/reschedule - перепланировать рассылки"""
+
+@admin_only
+async def admin_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE, user):
     """Расширенная админская статистика"""
-    user = update.effective_user
-    user_id = user.id
     username = user.first_name or "Пользователь"
     
-    if user_id != ADMIN_ID:
-        logger.warning(f"🚫 Не-админ {username} пытался получить статистику")
-        await update.message.reply_text("У вас нет доступа к этой команде.")
-        return
-    
     logger.info(f"👑 Админ {username} запросил статистику")
     
     # Асинхронно получаем статистику из разных источников
@@ -286,55 +460,34 @@ async def admin_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     else:
         batch_time_str = "ещё не было"
     
-    # Формируем подробное сообщение
-    stats_message = f"""👑 **ОПТИМИЗИРОВАННАЯ СТАТИСТИКА**
-
-📊 **База данных (SQLite):**
-👥 Активных пользователей: {db_stats.get('active_users', 0)}
-👤 Всего пользователей: {db_stats.get('total_users', 0)}
-🌞 Активных фраз: {db_stats.get('active_phrases', 0)}
-⏳ На модерации: {db_stats.get('pending_phrases', 0)}
-📈 Уведомлений за 24ч: {db_stats.get('notifications_24h', 0)}
-❌ Неудачных отправок: {db_stats.get('failed_notifications', 0)}
-💾 Кэш фраз: {db_stats.get('cache_size', 0)}
-
-🔔 **Планировщик (Батчинг):**
-📤 Всего рассылок: {scheduler_stats.get('total_notifications', 0)}
-✅ Отправлено: {scheduler_stats.get('total_sent', 0)}
-❌ Ошибок: {scheduler_stats.get('total_failed', 0)}
-⏱️ Время последней рассылки: {batch_time_str}
-📦 Размер батча: {scheduler_stats.get('batch_size', 0)}
-▶️ Статус: {'Работает' if scheduler_stats.get('is_running') else 'Остановлен'}
-📡 Отправляет сейчас: {'Да' if scheduler_stats.get('is_sending') else 'Нет'}
-
-🛡️ **Безопасность:**
-🚫 Заблокированных: {security_stats.get('blocked_users', 0)}
-👁️ Отслеживается: {security_stats.get('active_users_tracked', 0)}
-
-🚀 **Производительность:**
-Поддержка: 10,000+ пользователей
-Скорость: 1000+ сообщений/минуту
-Тип БД: SQLite с WAL режимом
-
-🔧 **Команды:**
-/admin - эта статистика
-/test_notification - тест рассылки админу
-/test_soon - тест через 1 минуту
-/reschedule - перепланировать рассылки"""
+    stats_message = _ADMIN_STATS_TEMPLATE.format_map({
+        'active_users': db_stats.get('active_users', 0),
+        'total_users': db_stats.get('total_users', 0),
+        'active_phrases': db_stats.get('active_phrases', 0),
+        'pending_phrases': db_stats.get('pending_phrases', 0),
+        'notifications_24h': db_stats.get('notifications_24h', 0),
+        'failed_notifications': db_stats.get('failed_notifications', 0),
+        'cache_size': db_stats.get('cache_size', 0),
+        'total_notifications': scheduler_stats.get('total_notifications', 0),
+        'total_sent': scheduler_stats.get('total_sent', 0),
+        'total_failed': scheduler_stats.get('total_failed', 0),
+        'batch_time': batch_time_str,
+        'batch_size': scheduler_stats.get('batch_size', 0),
+        'scheduler_status': 'Работает' if scheduler_stats.get('is_running') else 'Остановлен',
+        'is_sending': 'Да' if scheduler_stats.get('is_sending') else 'Нет',
+        'blocked_users': security_stats.get('blocked_users', 0),
+        'active_users_tracked': security_stats.get('active_users_tracked', 0),
+    })
     
     await update.message.reply_text(stats_message)
     logger.info("✅ Расширенная статистика отправлена")
 
-async def admin_test_notification(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@admin_only
+async def admin_test_notification(update: Update, context: ContextTypes.DEFAULT_TYPE, user):
     """Оптимизированное тестовое уведомление"""
-    user = update.effective_user
     user_id = user.id
     username = user.first_name or "Пользователь"
     
-    if user_id != ADMIN_ID:
-        await update.message.reply_text("У вас нет доступа к этой команде.")
-        return
-    
     logger.info(f"👑 Админ {username} запросил тест")
     
     if global_scheduler is not None:
@@ -353,18 +506,13 @@ async def admin_test_notification(update: Update, context: ContextTypes.DEFAULT_
             logger.error(f"❌ Исключение в test_notification: {e}")
             await update.message.reply_text(f"❌ Ошибка: {e}")
     else:
-        await update.message.reply_text("❌ Планировщик не инициализирован")
+        await update.message.reply_text(_SCHEDULER_NOT_READY_MESSAGE)
 
-async def admin_test_soon(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@admin_only
+async def admin_test_soon(update: Update, context: ContextTypes.DEFAULT_TYPE, user):
     """Тест рассылки через минуту"""
-    user = update.effective_user
-    user_id = user.id
     username = user.first_name or "Пользователь"
     
-    if user_id != ADMIN_ID:
-        await update.message.reply_text("У вас нет доступа к этой команде.")
-        return
-    
     logger.info(f"👑 Админ {username} запросил тест через минуту")
     
     if global_scheduler is not None:
@@ -380,18 +528,13 @@ async def admin_test_soon(update: Update, context: ContextTypes.DEFAULT_TYPE):
             logger.error(f"❌ Ошибка планирования теста: {e}")
             await update.message.reply_text(f"❌ Ошибка: {e}")
     else:
-        await update.message.reply_text("❌ Планировщик не инициализирован")
+        await update.message.reply_text(_SCHEDULER_NOT_READY_MESSAGE)
 
-async def admin_reschedule(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@admin_only
+async def admin_reschedule(update: Update, context: ContextTypes.DEFAULT_TYPE, user):
     """Перепланирование рассылок"""
-    user = update.effective_user
-    user_id = user.id
     username = user.first_name or "Пользователь"
     
-    if user_id != ADMIN_ID:
-        await update.message.reply_text("У вас нет доступа к этой команде.")
-        return
-    
     logger.info(f"👑 Админ {username} перепланирует рассылки")
     
     if global_scheduler is not None:
@@ -412,4 +555,4 @@ async def admin_reschedule(update: Update, context: ContextTypes.DEFAULT_TYPE):
             logger.error(f"❌ Ошибка перепланирования: {e}")
             await update.message.reply_text(f"❌ Ошибка: {e}")
     else:
-        await update.message.reply_text("❌ Планировщик не инициализирован")
\ No newline at end of file
+        await update.message.reply_text(_SCHEDULER_NOT_READY_MESSAGE)
\ No newline at end of file
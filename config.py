@@ -19,7 +19,12 @@ MESSAGE_COOLDOWN = 300    # Cooldown между сообщениями (5 мин
 # Настройки рассылки
 DAILY_NOTIFICATIONS = 4  # Количество автоматических уведомлений в день
 
-# Стоп-слова для фильтрации
+# Сколько апдейтов Telegram обрабатывается одновременно (остальные ждут в очереди)
+CONCURRENT_UPDATES = 32
+
+# Стоп-слова для фильтрации.
+# Ищутся как подстроки, а не целые слова, чтобы ловить словоформы
+# ("дурак" -> "дураки"), поэтому поиск по множеству токенов здесь не подходит.
 STOP_WORDS = [
     "дурак", "идиот", "урод", "сука", "блядь", "пиздец",
     "хуй", "ебать", "говно", "мудак", "пидор", "дебил",
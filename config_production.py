@@ -56,6 +56,9 @@ DAILY_NOTIFICATIONS = 4
 BATCH_SIZE = int(os.getenv('BATCH_SIZE', '50'))     # По умолчанию 50
 BATCH_DELAY = float(os.getenv('BATCH_DELAY', '0.5')) # По умолчанию 0.5с
 
+# Одновременно обрабатываемые апдейты Telegram
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '64'))
+
 # Соединения с базой данных  
 DB_POOL_SIZE = 20        # Максимум соединений с БД
 DB_TIMEOUT = 30          # Таймаут запросов к БД
@@ -4,9 +4,12 @@ import asyncio
 import aiosqlite
 import logging
 import os
+import pathlib
 import random
+from collections import Counter
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
-from typing import List, Set, Dict, Optional
+from typing import AsyncIterator, Callable, List, Set, Dict, Optional, Union
 from dataclasses import dataclass
 import time
 
@@ -14,6 +17,102 @@ from config import PHRASES_FILE
 
 logger = logging.getLogger(__name__)
 
+# Схема БД: выполняется одним скриптом в одной транзакции
+SCHEMA_SQL = """
+BEGIN IMMEDIATE;
+
+-- Пользователи
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT,
+    first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    is_active BOOLEAN DEFAULT 1,
+    notification_count INTEGER DEFAULT 0
+);
+
+-- Фразы
+CREATE TABLE IF NOT EXISTS phrases (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    text TEXT NOT NULL UNIQUE,
+    source TEXT DEFAULT 'system',
+    status TEXT DEFAULT 'active',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    user_id INTEGER,
+    usage_count INTEGER DEFAULT 0,
+    quality_bitmask INTEGER,
+    FOREIGN KEY (user_id) REFERENCES users (user_id)
+);
+
+-- Логи уведомлений
+CREATE TABLE IF NOT EXISTS notification_logs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    phrase_id INTEGER NOT NULL,
+    sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    status TEXT DEFAULT 'sent',
+    error_message TEXT,
+    retry_count INTEGER DEFAULT 0,
+    FOREIGN KEY (user_id) REFERENCES users (user_id),
+    FOREIGN KEY (phrase_id) REFERENCES phrases (id)
+);
+
+-- Индексы для производительности.
+-- id/user_id - это rowid, он и так хранится в каждом индексе.
+-- Покрывающие индексы: обновление кэша фраз и счетчик за 24 часа не читают таблицу
+CREATE INDEX IF NOT EXISTS idx_users_active ON users(is_active);
+DROP INDEX IF EXISTS idx_phrases_status;
+CREATE INDEX IF NOT EXISTS idx_phrases_status_text ON phrases(status, text);
+-- Частичные индексы для модерации: очередь в порядке поступления,
+-- счетчик новых фраз и авторы фраз пользователей
+CREATE INDEX IF NOT EXISTS idx_phrases_pending_created ON phrases(created_at, id) WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS idx_phrases_user_created ON phrases(created_at) WHERE source = 'user';
+CREATE INDEX IF NOT EXISTS idx_phrases_user_source ON phrases(user_id, status) WHERE source = 'user';
+DROP INDEX IF EXISTS idx_notifications_status;
+CREATE INDEX IF NOT EXISTS idx_notifications_status_sent_at ON notification_logs(status, sent_at);
+CREATE INDEX IF NOT EXISTS idx_notifications_user ON notification_logs(user_id);
+
+COMMIT;
+"""
+
+# Размер кэша подготовленных выражений sqlite3 на соединение (по умолчанию 128)
+STATEMENT_CACHE_SIZE = 256
+
+# Запросы горячих путей: один и тот же текст - попадание в кэш выражений
+SQL_UPSERT_USER = """
+    INSERT INTO users 
+    (user_id, username, last_activity) 
+    VALUES (?, ?, CURRENT_TIMESTAMP)
+    ON CONFLICT(user_id) DO UPDATE SET
+        username = excluded.username,
+        last_activity = excluded.last_activity,
+        is_active = 1
+"""
+SQL_SELECT_ACTIVE_USERS_PAGE = """
+    SELECT user_id FROM users
+    WHERE is_active = 1 AND user_id > ?
+    ORDER BY user_id LIMIT ?
+"""
+SQL_SELECT_ACTIVE_PHRASES = "SELECT id, text FROM phrases WHERE status = 'active'"
+SQL_ADD_PHRASE_USAGE = "UPDATE phrases SET usage_count = usage_count + ? WHERE id = ?"
+SQL_INSERT_NOTIFICATION_LOG = """
+    INSERT INTO notification_logs 
+    (user_id, phrase_id, status, error_message) 
+    VALUES (?, ?, ?, ?)
+"""
+SQL_ADD_NOTIFICATION_COUNT = "UPDATE users SET notification_count = notification_count + ? WHERE user_id = ?"
+SQL_MARK_USER_INACTIVE = "UPDATE users SET is_active = 0 WHERE user_id = ?"
+
+def _read_phrases_file(path: str) -> List[str]:
+    """Читаем фразы из файла (блокирующий вызов, выполняется в потоке)"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+def _read_user_ids_file(path: str) -> List[int]:
+    """Читаем ID пользователей из файла (блокирующий вызов, выполняется в потоке)"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return [int(line.strip()) for line in f if line.strip().isdigit()]
+
 @dataclass
 class User:
     user_id: int
@@ -34,11 +133,33 @@ class Phrase:
 class OptimizedDatabase:
     """Оптимизированная база данных для масштабирования"""
     
-    def __init__(self, db_path: str = "data/matsav_tov.db"):
+    def __init__(self, db_path: str = "data/matsav_tov.db", pool_size: int = 4):
         self.db_path = db_path
-        self._phrase_cache = {}
-        self._cache_timestamp = 0
-        self._cache_ttl = 300  # 5 минут
+        self._pool_size = pool_size
+        self._pool = None  # asyncio.Queue свободных соединений, создается в init_database
+        self._read_pool = None  # то же для соединений только на чтение (mode=ro)
+        self._connections = []
+        self._phrase_cache = ()  # кортеж (id, text) — random.choice без копирования
+        self._phrase_cache_dirty = True  # выставляют те, кто меняет набор активных фраз
+        self._cache_refresh_task = None
+        self.pending_version = 0  # растет с каждой новой фразой на модерации
+        self._stats_cache = None
+        self._stats_cache_timestamp = 0
+        self._stats_cache_ttl = 30  # секунд
+        
+        # Буферы записи: пишутся на диск пачками (write-behind)
+        self._pending_logs = []  # (user_id, phrase_id, status, error_message)
+        self._pending_sent_counts = {}  # user_id -> число отправленных
+        self._pending_usage = Counter()  # phrase_id -> число показов
+        self._pending_inactive = set()  # user_id заблокировавших бота
+        self._flush_interval = 1.0  # секунд
+        self._flush_batch_size = 500
+        # При сбоях записи буферы возвращаются обратно; логи ограничены (счетчики и так
+        # не больше числа пользователей и фраз), старейшие лишние отбрасываются
+        self._max_pending_logs = 50000
+        self._flush_retry_at = 0.0  # после ошибки записи пачку по размеру не пишем до этого времени
+        self._flush_lock = None  # asyncio.Lock, создается внутри цикла событий
+        self._flush_task = None
         
         # Создаем папку если нужно
         os.makedirs(os.path.dirname(db_path), exist_ok=True)
@@ -46,75 +167,114 @@ class OptimizedDatabase:
     async def init_database(self):
         """Инициализируем базу данных"""
         try:
-            # ИСПРАВЛЕНИЕ: Сначала настраиваем PRAGMA вне транзакции
-            async with aiosqlite.connect(self.db_path) as db:
-                # Включаем WAL режим для лучшей производительности
-                await db.execute("PRAGMA journal_mode=WAL")
-                await db.execute("PRAGMA synchronous=NORMAL") 
-                await db.execute("PRAGMA cache_size=10000")
-                await db.execute("PRAGMA temp_store=memory")
+            # Открываем пул соединений (PRAGMA применяются при открытии)
+            if self._pool is None:
+                self._pool = await self._open_pool()
             
             # Затем создаем таблицы и мигрируем данные
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.connection() as db:
                 await self._create_tables(db)
                 await self._migrate_from_files(db)
                 await db.commit()
             
+            # Читатели открываются, когда файл БД и WAL уже созданы
+            if self._read_pool is None:
+                self._read_pool = await self._open_pool(read_only=True)
+            
+            # Фоновая запись накопленных логов
+            if self._flush_task is None:
+                self._flush_task = asyncio.create_task(self._flush_loop())
+            
             logger.info("✅ База данных инициализирована")
             
         except Exception as e:
             logger.error(f"❌ Ошибка инициализации БД: {e}")
             raise
     
-    async def _create_tables(self, db: aiosqlite.Connection):
-        """Создаем таблицы"""
+    async def _connect(self, read_only: bool = False) -> aiosqlite.Connection:
+        """Открываем соединение и настраиваем его один раз"""
+        if read_only:
+            # В WAL читатели не мешают писателю и друг другу
+            uri = pathlib.Path(self.db_path).resolve().as_uri() + "?mode=ro"
+            db = await aiosqlite.connect(uri, uri=True, cached_statements=STATEMENT_CACHE_SIZE)
+        else:
+            db = await aiosqlite.connect(self.db_path, cached_statements=STATEMENT_CACHE_SIZE)
+            # ИСПРАВЛЕНИЕ: PRAGMA выполняются вне транзакции
+            # Включаем WAL режим для лучшей производительности
+            await db.execute("PRAGMA journal_mode=WAL")
+            await db.execute("PRAGMA synchronous=NORMAL")
+            await db.execute("PRAGMA wal_autocheckpoint=1000")
+        
+        await db.execute("PRAGMA cache_size=-65536")  # 64 МБ (отрицательное значение - в КБ)
+        await db.execute("PRAGMA mmap_size=268435456")  # 256 МБ: чтение через mmap без read()
+        await db.execute("PRAGMA temp_store=memory")
+        await db.execute("PRAGMA busy_timeout=5000")  # ждем блокировку внутри SQLite
+        return db
+    
+    async def _open_pool(self, read_only: bool = False) -> asyncio.Queue:
+        """Открываем постоянные соединения вместо подключения на каждый запрос"""
+        pool = asyncio.Queue()
+        for _ in range(self._pool_size):
+            db = await self._connect(read_only)
+            self._connections.append(db)
+            pool.put_nowait(db)
         
-        # Пользователи
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                is_active BOOLEAN DEFAULT 1,
-                notification_count INTEGER DEFAULT 0
-            )
-        """)
+        logger.info(f"🔌 Пул соединений открыт: {self._pool_size}{' (только чтение)' if read_only else ''}")
+        return pool
+    
+    @asynccontextmanager
+    async def connection(self, read_only: bool = False):
+        """Берем соединение из пула на время операции (им пользуется и модерация)"""
+        pool = self._read_pool if read_only and self._read_pool is not None else self._pool
+        if pool is None:
+            raise RuntimeError("База данных не инициализирована")
+        
+        db = await pool.get()
+        try:
+            yield db
+        except BaseException:
+            # Не возвращаем в пул соединение с незавершенной транзакцией
+            await db.rollback()
+            raise
+        finally:
+            pool.put_nowait(db)
+    
+    async def close(self):
+        """Записываем буферы и закрываем все соединения пула"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
         
-        # Фразы
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS phrases (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                text TEXT NOT NULL UNIQUE,
-                source TEXT DEFAULT 'system',
-                status TEXT DEFAULT 'active',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                user_id INTEGER,
-                usage_count INTEGER DEFAULT 0,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        """)
+        if self._pool is not None:
+            await self.flush_pending_writes()
         
-        # Логи уведомлений
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS notification_logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                phrase_id INTEGER NOT NULL,
-                sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                status TEXT DEFAULT 'sent',
-                error_message TEXT,
-                retry_count INTEGER DEFAULT 0,
-                FOREIGN KEY (user_id) REFERENCES users (user_id),
-                FOREIGN KEY (phrase_id) REFERENCES phrases (id)
-            )
-        """)
+        connections, self._connections = self._connections, []
+        self._pool = None
+        self._read_pool = None
         
-        # Создаем индексы для производительности
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_users_active ON users(is_active)")
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_phrases_status ON phrases(status)")
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_notifications_status ON notification_logs(status)")
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_notifications_user ON notification_logs(user_id)")
+        for db in connections:
+            try:
+                await db.close()
+            except Exception as e:
+                logger.error(f"❌ Ошибка закрытия соединения: {e}")
+        
+        if connections:
+            logger.info("🔌 Пул соединений закрыт")
+    
+    async def _create_tables(self, db: aiosqlite.Connection):
+        """Создаем таблицы и индексы одним скриптом"""
+        await db.executescript(SCHEMA_SQL)
+        
+        # Колонка quality_bitmask появилась позже: добавляем в старые БД
+        cursor = await db.execute("PRAGMA table_info(phrases)")
+        columns = {row[1] for row in await cursor.fetchall()}
+        if 'quality_bitmask' not in columns:
+            await db.execute("ALTER TABLE phrases ADD COLUMN quality_bitmask INTEGER")
+            logger.info("🔧 Добавлена колонка phrases.quality_bitmask")
     
     async def _migrate_from_files(self, db: aiosqlite.Connection):
         """Мигрируем данные из файлов"""
@@ -127,28 +287,24 @@ class OptimizedDatabase:
             
             # Мигрируем фразы из файла
             if os.path.exists(PHRASES_FILE):
-                with open(PHRASES_FILE, 'r', encoding='utf-8') as f:
-                    phrases = [line.strip() for line in f if line.strip()]
+                phrases = await asyncio.to_thread(_read_phrases_file, PHRASES_FILE)
                 
-                for phrase in phrases:
-                    await db.execute(
-                        "INSERT OR IGNORE INTO phrases (text, source, status) VALUES (?, ?, ?)",
-                        (phrase, 'system', 'active')
-                    )
+                await db.executemany(
+                    "INSERT OR IGNORE INTO phrases (text, source, status) VALUES (?, 'system', 'active')",
+                    ((phrase,) for phrase in phrases)
+                )
                 
                 logger.info(f"📥 Мигрировали {len(phrases)} системных фраз")
             
             # Мигрируем пользователей из файла
             users_file = "data/users.txt"
             if os.path.exists(users_file):
-                with open(users_file, 'r', encoding='utf-8') as f:
-                    user_ids = [int(line.strip()) for line in f if line.strip().isdigit()]
+                user_ids = await asyncio.to_thread(_read_user_ids_file, users_file)
                 
-                for user_id in user_ids:
-                    await db.execute(
-                        "INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)",
-                        (user_id, f"User_{user_id}")
-                    )
+                await db.executemany(
+                    "INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)",
+                    ((user_id, f"User_{user_id}") for user_id in user_ids)
+                )
                 
                 logger.info(f"📥 Мигрировали {len(user_ids)} пользователей")
             
@@ -158,12 +314,15 @@ class OptimizedDatabase:
     async def add_user(self, user_id: int, username: str = None) -> bool:
         """Добавляем пользователя"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                await db.execute("""
-                    INSERT OR REPLACE INTO users 
-                    (user_id, username, last_activity) 
-                    VALUES (?, ?, CURRENT_TIMESTAMP)
-                """, (user_id, username or f"User_{user_id}"))
+            # Вернувшегося пользователя не деактивирует отложенная запись. Под блокировкой:
+            # идущая запись буферов (с его деактивацией) завершится раньше UPSERT ниже
+            async with self._get_flush_lock():
+                self._pending_inactive.discard(user_id)
+            
+            async with self.connection() as db:
+                # UPSERT: first_seen и notification_count сохраняются,
+                # вернувшийся через /start пользователь снова активен
+                await db.execute(SQL_UPSERT_USER, (user_id, username or f"User_{user_id}"))
                 await db.commit()
             
             logger.info(f"👤 Добавлен/обновлен пользователь {username} (ID: {user_id})")
@@ -173,38 +332,52 @@ class OptimizedDatabase:
             logger.error(f"❌ Ошибка добавления пользователя: {e}")
             return False
     
-    async def get_active_users(self) -> List[int]:
-        """Получаем активных пользователей"""
-        try:
-            async with aiosqlite.connect(self.db_path) as db:
-                cursor = await db.execute(
-                    "SELECT user_id FROM users WHERE is_active = 1"
-                )
-                users = await cursor.fetchall()
-                return [user[0] for user in users]
-                
-        except Exception as e:
-            logger.error(f"❌ Ошибка получения пользователей: {e}")
-            return []
+    async def iter_active_users(self, batch_size: Union[int, Callable[[], int]]) -> AsyncIterator[List[int]]:
+        """Отдаем активных пользователей пачками по batch_size.
+        
+        Каждая пачка - короткий запрос по индексу с продолжением от последнего id,
+        поэтому соединение и снимок WAL не удерживаются на всю рассылку.
+        batch_size может быть функцией: размер читается заново для каждой пачки.
+        """
+        last_user_id = -1
+        while True:
+            page_size = batch_size() if callable(batch_size) else batch_size
+            async with self.connection(read_only=True) as db:
+                cursor = await db.execute(SQL_SELECT_ACTIVE_USERS_PAGE, (last_user_id, page_size))
+                rows = await cursor.fetchall()
+            
+            if not rows:
+                return
+            
+            batch = [row[0] for row in rows]
+            last_user_id = batch[-1]
+            yield batch
+            
+            if len(batch) < page_size:
+                return
     
     async def get_random_phrase(self) -> Optional[str]:
         """Получаем случайную фразу с кэшированием"""
         try:
             # Проверяем кэш
-            current_time = time.time()
-            if (current_time - self._cache_timestamp) > self._cache_ttl or not self._phrase_cache:
+            if not self._phrase_cache:
                 await self._refresh_phrase_cache()
+            elif self._phrase_cache_dirty:
+                # Кэш устарел: обновляем в фоне, а пока выбираем из прежнего (равномерно)
+                self._schedule_cache_refresh()
             
             if not self._phrase_cache:
                 return "Ты не один. מצב טוב."
             
-            # Выбираем случайную фразу
-            phrase_data = random.choice(list(self._phrase_cache.values()))
+            # Выбираем случайную фразу из кэша
+            phrase_row = random.choice(self._phrase_cache)
             
-            # Обновляем счетчик использования асинхронно
-            asyncio.create_task(self._increment_phrase_usage(phrase_data['id']))
+            phrase_id, phrase_text = phrase_row
             
-            return phrase_data['text']
+            # Счетчик использования запишется в БД вместе с остальными буферами
+            self._pending_usage[phrase_id] += 1
+            
+            return phrase_text
             
         except Exception as e:
             logger.error(f"❌ Ошибка получения фразы: {e}")
@@ -212,45 +385,41 @@ class OptimizedDatabase:
     
     async def _refresh_phrase_cache(self):
         """Обновляем кэш фраз"""
+        # Сбрасываем до чтения: инвалидация во время запроса вызовет новое обновление
+        self._phrase_cache_dirty = False
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                cursor = await db.execute(
-                    "SELECT id, text FROM phrases WHERE status = 'active'"
-                )
+            async with self.connection(read_only=True) as db:
+                cursor = await db.execute(SQL_SELECT_ACTIVE_PHRASES)
                 phrases = await cursor.fetchall()
                 
-                self._phrase_cache = {
-                    phrase[0]: {'id': phrase[0], 'text': phrase[1]} 
-                    for phrase in phrases
-                }
-                self._cache_timestamp = time.time()
+                self._phrase_cache = tuple(phrases)
                 
                 logger.info(f"🔄 Кэш фраз обновлен: {len(self._phrase_cache)} фраз")
                 
         except Exception as e:
+            self._phrase_cache_dirty = True
             logger.error(f"❌ Ошибка обновления кэша: {e}")
     
-    async def _increment_phrase_usage(self, phrase_id: int):
-        """Увеличиваем счетчик использования фразы"""
-        try:
-            async with aiosqlite.connect(self.db_path) as db:
-                await db.execute(
-                    "UPDATE phrases SET usage_count = usage_count + 1 WHERE id = ?",
-                    (phrase_id,)
-                )
-                await db.commit()
-        except Exception as e:
-            logger.error(f"❌ Ошибка обновления счетчика: {e}")
+    def invalidate_phrase_cache(self):
+        """Помечаем кэш фраз устаревшим (после изменения активных фраз)"""
+        self._phrase_cache_dirty = True
     
-    async def save_user_phrase(self, user_id: int, username: str, phrase: str) -> bool:
-        """Сохраняем фразу от пользователя"""
+    def _schedule_cache_refresh(self):
+        """Запускаем обновление кэша в фоне, если оно еще не идет"""
+        if self._cache_refresh_task is None or self._cache_refresh_task.done():
+            self._cache_refresh_task = asyncio.create_task(self._refresh_phrase_cache())
+    
+    async def save_user_phrase(self, user_id: int, username: str, phrase: str,
+                               quality_bitmask: Optional[int] = None) -> bool:
+        """Сохраняем фразу от пользователя (с признаками качества для автоодобрения)"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.connection() as db:
                 await db.execute("""
-                    INSERT INTO phrases (text, source, status, user_id) 
-                    VALUES (?, 'user', 'pending', ?)
-                """, (phrase, user_id))
+                    INSERT INTO phrases (text, source, status, user_id, quality_bitmask) 
+                    VALUES (?, 'user', 'pending', ?, ?)
+                """, (phrase, user_id, quality_bitmask))
                 await db.commit()
+            self.pending_version += 1
             
             logger.info(f"💾 Сохранили фразу от {username}: '{phrase[:50]}...'")
             return True
@@ -260,61 +429,103 @@ class OptimizedDatabase:
             return False
     
     async def log_notification(self, user_id: int, phrase_id: int, status: str, error: str = None):
-        """Логируем отправку уведомления"""
-        try:
-            async with aiosqlite.connect(self.db_path) as db:
-                await db.execute("""
-                    INSERT INTO notification_logs 
-                    (user_id, phrase_id, status, error_message) 
-                    VALUES (?, ?, ?, ?)
-                """, (user_id, phrase_id, status, error))
-                
-                # Обновляем счетчик уведомлений у пользователя
-                if status == 'sent':
-                    await db.execute(
-                        "UPDATE users SET notification_count = notification_count + 1 WHERE user_id = ?",
-                        (user_id,)
-                    )
-                
-                await db.commit()
-                
-        except Exception as e:
-            logger.error(f"❌ Ошибка логирования уведомления: {e}")
+        """Логируем отправку уведомления (в буфер, на диск - пачкой)"""
+        self._pending_logs.append((user_id, phrase_id, status, error))
+        
+        # Счетчик уведомлений у пользователя обновится при записи буфера
+        if status == 'sent':
+            self._pending_sent_counts[user_id] = self._pending_sent_counts.get(user_id, 0) + 1
+        
+        if len(self._pending_logs) >= self._flush_batch_size and time.monotonic() >= self._flush_retry_at:
+            await self.flush_pending_writes()
     
-    async def mark_user_inactive(self, user_id: int):
-        """Помечаем пользователя как неактивного (заблокировал бота)"""
-        try:
-            async with aiosqlite.connect(self.db_path) as db:
-                await db.execute(
-                    "UPDATE users SET is_active = 0 WHERE user_id = ?",
-                    (user_id,)
-                )
-                await db.commit()
+    def _get_flush_lock(self) -> asyncio.Lock:
+        """Блокировка записи буферов (создается внутри цикла событий)"""
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        return self._flush_lock
+    
+    async def flush_pending_writes(self):
+        """Записываем накопленные логи и счетчики одной транзакцией"""
+        async with self._get_flush_lock():
+            if not self._pending_logs and not self._pending_usage and not self._pending_inactive:
+                return
             
-            logger.info(f"🚫 Пользователь {user_id} помечен как неактивный")
+            logs, self._pending_logs = self._pending_logs, []
+            sent_counts, self._pending_sent_counts = self._pending_sent_counts, {}
+            usage, self._pending_usage = self._pending_usage, Counter()
+            inactive, self._pending_inactive = self._pending_inactive, set()
             
-        except Exception as e:
-            logger.error(f"❌ Ошибка деактивации пользователя: {e}")
+            try:
+                async with self.connection() as db:
+                    await db.executemany(SQL_INSERT_NOTIFICATION_LOG, logs)
+                    
+                    await db.executemany(
+                        SQL_ADD_NOTIFICATION_COUNT,
+                        ((count, user_id) for user_id, count in sent_counts.items())
+                    )
+                    
+                    await db.executemany(
+                        SQL_ADD_PHRASE_USAGE,
+                        ((count, phrase_id) for phrase_id, count in usage.items())
+                    )
+                    
+                    await db.executemany(SQL_MARK_USER_INACTIVE, ((user_id,) for user_id in inactive))
+                    
+                    await db.commit()
+                    
+            except Exception as e:
+                logger.error(f"❌ Ошибка записи буферов ({len(logs)} логов, {len(usage)} счетчиков фраз, {len(inactive)} деактиваций): {e}")
+                # Транзакция откачена: возвращаем данные, запишем при следующей попытке
+                self._restore_pending_writes(logs, sent_counts, usage, inactive)
+                self._flush_retry_at = time.monotonic() + self._flush_interval
+    
+    def _restore_pending_writes(self, logs: List[tuple], sent_counts: Dict[int, int],
+                                usage: Counter, inactive: Set[int]):
+        """Возвращаем в буферы данные неудавшейся записи (перед накопленными за это время)"""
+        self._pending_logs[:0] = logs
+        overflow = len(self._pending_logs) - self._max_pending_logs
+        if overflow > 0:
+            del self._pending_logs[:overflow]
+            logger.warning(f"⚠️ Буфер логов переполнен, отброшено {overflow} старейших записей")
+        
+        for user_id, count in sent_counts.items():
+            self._pending_sent_counts[user_id] = self._pending_sent_counts.get(user_id, 0) + count
+        self._pending_usage.update(usage)
+        self._pending_inactive |= inactive
+    
+    async def _flush_loop(self):
+        """Периодически записываем буферы на диск"""
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            await self.flush_pending_writes()
+    
+    async def mark_user_inactive(self, user_id: int):
+        """Помечаем пользователя как неактивного (в буфер: за рассылку - одной транзакцией)"""
+        self._pending_inactive.add(user_id)
     
     async def get_stats(self) -> Dict:
-        """Получаем статистику базы данных"""
+        """Получаем статистику базы данных (с коротким кэшем)"""
+        if self._stats_cache and (time.monotonic() - self._stats_cache_timestamp) < self._stats_cache_ttl:
+            return {**self._stats_cache, 'cache_size': len(self._phrase_cache)}
+        
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                # Пользователи
-                cursor = await db.execute("SELECT COUNT(*) FROM users WHERE is_active = 1")
-                active_users = (await cursor.fetchone())[0]
-                
-                cursor = await db.execute("SELECT COUNT(*) FROM users")
-                total_users = (await cursor.fetchone())[0]
-                
-                # Фразы
-                cursor = await db.execute("SELECT COUNT(*) FROM phrases WHERE status = 'active'")
-                active_phrases = (await cursor.fetchone())[0]
+            async with self.connection(read_only=True) as db:
+                # Пользователи: один проход по таблице
+                cursor = await db.execute(
+                    "SELECT COALESCE(SUM(is_active = 1), 0), COUNT(*) FROM users"
+                )
+                active_users, total_users = await cursor.fetchone()
                 
-                cursor = await db.execute("SELECT COUNT(*) FROM phrases WHERE status = 'pending'")
-                pending_phrases = (await cursor.fetchone())[0]
+                # Фразы: один проход по таблице
+                cursor = await db.execute("""
+                    SELECT COALESCE(SUM(status = 'active'), 0), COALESCE(SUM(status = 'pending'), 0)
+                    FROM phrases
+                """)
+                active_phrases, pending_phrases = await cursor.fetchone()
                 
-                # Уведомления за последние 24 часа
+                # Уведомления за последние 24 часа. Логи считаем отдельными запросами:
+                # оба идут по индексу статуса, а общий SUM читал бы всю растущую таблицу
                 cursor = await db.execute("""
                     SELECT COUNT(*) FROM notification_logs 
                     WHERE sent_at > datetime('now', '-1 day') AND status = 'sent'
@@ -325,15 +536,17 @@ class OptimizedDatabase:
                 cursor = await db.execute("SELECT COUNT(*) FROM notification_logs WHERE status = 'failed'")
                 failed_notifications = (await cursor.fetchone())[0]
                 
-                return {
+                self._stats_cache = {
                     'active_users': active_users,
                     'total_users': total_users,
                     'active_phrases': active_phrases,
                     'pending_phrases': pending_phrases,
                     'notifications_24h': notifications_24h,
-                    'failed_notifications': failed_notifications,
-                    'cache_size': len(self._phrase_cache)
+                    'failed_notifications': failed_notifications
                 }
+                self._stats_cache_timestamp = time.monotonic()
+                
+                return {**self._stats_cache, 'cache_size': len(self._phrase_cache)}
                 
         except Exception as e:
             logger.error(f"❌ Ошибка получения статистики: {e}")
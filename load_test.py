@@ -5,6 +5,7 @@ import aiosqlite
 import time
 import random
 import logging
+import math
 from datetime import datetime
 from typing import List, Dict
 import psutil
@@ -21,11 +22,54 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+class LatencyHistogram:
+    """Гистограмма задержек с логарифмическими корзинами: память не растет с числом замеров"""
+    
+    def __init__(self, min_value: float = 1e-6, max_value: float = 60.0, buckets_per_decade: int = 100):
+        # 100 корзин на порядок - погрешность перцентилей около 2.3%
+        self._min_value = min_value
+        self._log_min = math.log10(min_value)
+        self._scale = buckets_per_decade
+        self._counts = [0] * (math.ceil((math.log10(max_value) - self._log_min) * buckets_per_decade) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+    
+    def record(self, value: float):
+        """Добавляет замер (в секундах)"""
+        index = int((math.log10(max(value, self._min_value)) - self._log_min) * self._scale)
+        self._counts[min(index, len(self._counts) - 1)] += 1
+        self.count += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+    
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+    
+    def percentile(self, percent: float) -> float:
+        """Перцентиль: верхняя граница корзины, но не больше максимума"""
+        if not self.count:
+            return 0.0
+        
+        target = self.count * percent / 100
+        seen = 0
+        for index, bucket_count in enumerate(self._counts):
+            seen += bucket_count
+            if seen >= target:
+                return min(10 ** (self._log_min + (index + 1) / self._scale), self.max)
+        return self.max
+
 class LoadTester:
     """Класс для нагрузочного тестирования бота"""
     
     def __init__(self, db_path: str = "data/matsav_tov.db"):
         self.db_path = db_path
+        self._phrase_ids = None  # ID активных фраз, загружаются один раз на все тесты
         self.test_results = {
             'users_created': 0,
             'phrases_retrieved': 0,
@@ -40,25 +84,21 @@ class LoadTester:
         logger.info(f"🔧 Создание {count} тестовых пользователей...")
         
         start_time = time.time()
-        user_ids = []
+        
+        # Генерируем уникальные ID (начиная с 1000000)
+        user_ids = [1000000 + i for i in range(count)]
         
         try:
             async with aiosqlite.connect(self.db_path) as db:
-                for i in range(count):
-                    # Генерируем уникальные ID (начиная с 1000000)
-                    user_id = 1000000 + i
-                    username = f"LoadTest_User_{i}"
-                    
-                    await db.execute("""
-                        INSERT OR REPLACE INTO users 
-                        (user_id, username, is_active) 
-                        VALUES (?, ?, 1)
-                    """, (user_id, username))
-                    
-                    user_ids.append(user_id)
-                    
-                    if (i + 1) % 100 == 0:
-                        logger.info(f"✅ Создано {i + 1}/{count} пользователей")
+                # Одна транзакция и один подготовленный запрос на всех пользователей
+                await db.executemany("""
+                    INSERT INTO users 
+                    (user_id, username, is_active) 
+                    VALUES (?, ?, 1)
+                    ON CONFLICT(user_id) DO UPDATE SET
+                        username = excluded.username,
+                        is_active = 1
+                """, ((user_id, f"LoadTest_User_{i}") for i, user_id in enumerate(user_ids)))
                 
                 await db.commit()
                 
@@ -72,24 +112,41 @@ class LoadTester:
         logger.info(f"✅ {count} тестовых пользователей создано за {elapsed:.2f}с")
         return user_ids
     
+    async def prefetch_phrase_ids(self) -> List[int]:
+        """Загружает ID активных фраз один раз вместо ORDER BY RANDOM() на каждый запрос"""
+        if self._phrase_ids is None:
+            async with aiosqlite.connect(self.db_path) as db:
+                cursor = await db.execute("SELECT id FROM phrases WHERE status = 'active'")
+                self._phrase_ids = [row[0] for row in await cursor.fetchall()]
+            
+            logger.info(f"📥 Загружено {len(self._phrase_ids)} ID активных фраз")
+        
+        return self._phrase_ids
+    
     async def test_phrase_retrieval(self, user_count: int, iterations: int = 1000) -> Dict:
         """Тестирует скорость получения фраз"""
         logger.info(f"🎯 Тестирование получения фраз ({iterations} запросов)")
         
-        start_time = time.time()
+        phrase_ids = await self.prefetch_phrase_ids()
+        
+        start_time = time.perf_counter()
         successful_requests = 0
         errors = 0
-        response_times = []
+        response_times = LatencyHistogram()
+        window_total = 0.0  # сумма времени за последние 100 запросов
         
         try:
             async with aiosqlite.connect(self.db_path) as db:
-                for i in range(iterations):
-                    request_start = time.time()
+                if not phrase_ids:
+                    logger.error("❌ Нет активных фраз для тестирования")
+                
+                for i in range(iterations if phrase_ids else 0):
+                    request_start = time.perf_counter()
                     
                     try:
-                        # Имитируем получение случайной фразы
+                        # Имитируем получение случайной фразы: поиск по первичному ключу
                         cursor = await db.execute(
-                            "SELECT text FROM phrases WHERE status = 'active' ORDER BY RANDOM() LIMIT 1"
+                            "SELECT text FROM phrases WHERE id = ?", (random.choice(phrase_ids),)
                         )
                         phrase = await cursor.fetchone()
                         
@@ -102,22 +159,26 @@ class LoadTester:
                         errors += 1
                         logger.error(f"❌ Ошибка запроса {i}: {e}")
                     
-                    request_time = time.time() - request_start
-                    response_times.append(request_time)
+                    request_time = time.perf_counter() - request_start
+                    response_times.record(request_time)
+                    window_total += request_time
                     
                     # Мониторинг каждые 100 запросов
                     if (i + 1) % 100 == 0:
-                        avg_time = sum(response_times[-100:]) / 100
+                        avg_time = window_total / 100
+                        window_total = 0.0
                         logger.info(f"📊 {i + 1}/{iterations} - Среднее время: {avg_time*1000:.1f}ms")
-                    
-                    # Небольшая задержка для реалистичности
-                    await asyncio.sleep(0.001)
         
         except Exception as e:
             logger.error(f"❌ Критическая ошибка тестирования: {e}")
         
-        elapsed = time.time() - start_time
-        avg_response_time = sum(response_times) / len(response_times) if response_times else 0
+        elapsed = time.perf_counter() - start_time
+        avg_response_time = response_times.mean
+        
+        # Перцентили времени ответа
+        p50 = response_times.percentile(50)
+        p95 = response_times.percentile(95)
+        p99 = response_times.percentile(99)
         
         results = {
             'total_requests': iterations,
@@ -126,10 +187,15 @@ class LoadTester:
             'total_time': elapsed,
             'avg_response_time': avg_response_time,
             'requests_per_second': iterations / elapsed if elapsed > 0 else 0,
-            'min_response_time': min(response_times) if response_times else 0,
-            'max_response_time': max(response_times) if response_times else 0
+            'min_response_time': response_times.min if response_times.count else 0,
+            'max_response_time': response_times.max,
+            'p50_response_time': p50,
+            'p95_response_time': p95,
+            'p99_response_time': p99
         }
         
+        logger.info(f"⏱️ p50 {p50*1000:.2f}ms, p95 {p95*1000:.2f}ms, p99 {p99*1000:.2f}ms")
+        
         self.test_results.update(results)
         return results
     
@@ -141,6 +207,8 @@ class LoadTester:
         batch_delay = 0.5
         message_delay = 0.03
         
+        phrase_ids = await self.prefetch_phrase_ids()
+        
         start_time = time.time()
         total_sent = 0
         total_failed = 0
@@ -151,10 +219,12 @@ class LoadTester:
         try:
             async with aiosqlite.connect(self.db_path) as db:
                 # Получаем фразу для рассылки
-                cursor = await db.execute(
-                    "SELECT id, text FROM phrases WHERE status = 'active' ORDER BY RANDOM() LIMIT 1"
-                )
-                phrase_data = await cursor.fetchone()
+                phrase_data = None
+                if phrase_ids:
+                    cursor = await db.execute(
+                        "SELECT id, text FROM phrases WHERE id = ?", (random.choice(phrase_ids),)
+                    )
+                    phrase_data = await cursor.fetchone()
                 
                 if not phrase_data:
                     logger.error("❌ Нет доступных фраз для рассылки")
@@ -168,23 +238,26 @@ class LoadTester:
                     batch_start = time.time()
                     logger.info(f"📦 Батч {batch_num}/{len(batches)} ({len(batch_users)} пользователей)")
                     
-                    # Параллельно "отправляем" сообщения в батче
-                    tasks = []
-                    for user_id in batch_users:
-                        task = self._simulate_send_message(db, user_id, phrase_id)
-                        tasks.append(task)
+                    # Параллельно "отправляем" сообщения в батче (без обращений к БД)
+                    results = await asyncio.gather(
+                        *(self._simulate_send_message(user_id) for user_id in batch_users),
+                        return_exceptions=True
+                    )
                     
-                    # Ждем выполнения всех задач в батче
-                    results = await asyncio.gather(*tasks, return_exceptions=True)
+                    # Логируем "отправку" всего батча одним запросом
+                    sent_rows = [
+                        (user_id, phrase_id)
+                        for user_id, result in zip(batch_users, results)
+                        if result is True
+                    ]
+                    await db.executemany("""
+                        INSERT INTO notification_logs 
+                        (user_id, phrase_id, status) 
+                        VALUES (?, ?, 'sent')
+                    """, sent_rows)
                     
-                    # Подсчитываем результаты
-                    for result in results:
-                        if isinstance(result, Exception):
-                            total_failed += 1
-                        elif result:
-                            total_sent += 1
-                        else:
-                            total_failed += 1
+                    total_sent += len(sent_rows)
+                    total_failed += len(batch_users) - len(sent_rows)
                     
                     batch_time = time.time() - batch_start
                     logger.info(f"✅ Батч {batch_num} завершен за {batch_time:.2f}с")
@@ -216,30 +289,24 @@ class LoadTester:
         
         return results
     
-    async def _simulate_send_message(self, db: aiosqlite.Connection, user_id: int, phrase_id: int) -> bool:
+    async def _simulate_send_message(self, user_id: int) -> bool:
         """Имитирует отправку сообщения пользователю"""
         try:
             # Имитируем задержку отправки Telegram API
             await asyncio.sleep(0.03)
             
-            # Логируем "отправку"
-            await db.execute("""
-                INSERT INTO notification_logs 
-                (user_id, phrase_id, status) 
-                VALUES (?, ?, 'sent')
-            """, (user_id, phrase_id))
-            
             return True
             
         except Exception as e:
             logger.error(f"❌ Ошибка отправки {user_id}: {e}")
             return False
     
-    def monitor_system_resources(self) -> Dict:
+    async def monitor_system_resources(self) -> Dict:
         """Мониторинг системных ресурсов"""
         try:
             memory = psutil.virtual_memory()
-            cpu = psutil.cpu_percent(interval=1)
+            # cpu_percent(interval=1) спит секунду - выполняем вне цикла событий
+            cpu = await asyncio.to_thread(psutil.cpu_percent, 1)
             disk = psutil.disk_usage('/')
             
             resources = {
@@ -266,19 +333,26 @@ class LoadTester:
         
         try:
             async with aiosqlite.connect(self.db_path) as db:
+                # ID во временной таблице вместо IN (?, ?, ...) на тысячи параметров
+                await db.execute("CREATE TEMP TABLE IF NOT EXISTS cleanup_ids (user_id INTEGER PRIMARY KEY)")
+                await db.execute("DELETE FROM temp.cleanup_ids")
+                await db.executemany(
+                    "INSERT OR IGNORE INTO temp.cleanup_ids (user_id) VALUES (?)",
+                    ((user_id,) for user_id in user_ids)
+                )
+                
                 # Удаляем логи уведомлений
                 await db.execute(
-                    f"DELETE FROM notification_logs WHERE user_id IN ({','.join(['?'] * len(user_ids))})",
-                    user_ids
+                    "DELETE FROM notification_logs WHERE user_id IN (SELECT user_id FROM temp.cleanup_ids)"
                 )
                 
                 # Удаляем пользователей
                 await db.execute(
-                    f"DELETE FROM users WHERE user_id IN ({','.join(['?'] * len(user_ids))})",
-                    user_ids
+                    "DELETE FROM users WHERE user_id IN (SELECT user_id FROM temp.cleanup_ids)"
                 )
                 
                 await db.commit()
+                await db.execute("DROP TABLE temp.cleanup_ids")
                 
             logger.info("✅ Тестовые пользователи очищены")
             
@@ -295,6 +369,9 @@ class LoadTester:
         print(f"🎯 Успешных запросов: {self.test_results.get('successful_requests', 0)}")
         print(f"❌ Ошибок: {self.test_results.get('errors', 0)}")
         print(f"⚡ Среднее время ответа: {self.test_results.get('avg_response_time', 0)*1000:.1f}ms")
+        print(f"⏱️ p50/p95/p99: {self.test_results.get('p50_response_time', 0)*1000:.2f}/"
+              f"{self.test_results.get('p95_response_time', 0)*1000:.2f}/"
+              f"{self.test_results.get('p99_response_time', 0)*1000:.2f}ms")
         print(f"📈 Запросов в секунду: {self.test_results.get('requests_per_second', 0):.1f}")
         
         if self.test_results['memory_usage']:
@@ -318,6 +395,9 @@ async def run_load_test():
     
     tester = LoadTester()
     
+    # ID фраз загружаем до тестов, вне измеряемого времени
+    await tester.prefetch_phrase_ids()
+    
     # Конфигурация тестов
     test_configs = [
         {'users': 100, 'name': 'Малая нагрузка'},
@@ -334,7 +414,7 @@ async def run_load_test():
         
         try:
             # Мониторинг ресурсов до теста
-            resources_before = tester.monitor_system_resources()
+            resources_before = await tester.monitor_system_resources()
             logger.info(f"📊 Ресурсы до теста: CPU {resources_before.get('cpu_percent', 0):.1f}%, "
                        f"RAM {resources_before.get('memory_percent', 0):.1f}%")
             
@@ -352,7 +432,7 @@ async def run_load_test():
             notification_results = await tester.simulate_batch_notification(user_ids)
             
             # Мониторинг ресурсов после теста
-            resources_after = tester.monitor_system_resources()
+            resources_after = await tester.monitor_system_resources()
             logger.info(f"📊 Ресурсы после теста: CPU {resources_after.get('cpu_percent', 0):.1f}%, "
                        f"RAM {resources_after.get('memory_percent', 0):.1f}%")
             
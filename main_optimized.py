@@ -3,27 +3,64 @@
 import asyncio
 import logging
 import os
+import queue
 import signal
 import sys
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from telegram.ext import Application, CommandHandler, MessageHandler, filters
 
-from config import BOT_TOKEN, LOG_FILE
+from bot_handlers_optimized import (
+    start_command, text_message_handler, admin_stats_command,
+    admin_test_notification, admin_test_soon, admin_reschedule,
+    set_global_scheduler
+)
+from config import BOT_TOKEN, CONCURRENT_UPDATES, LOG_FILE
 from database_optimized import optimized_db
 from scheduler_optimized import OptimizedNotificationScheduler
 
+try:
+    import h2  # noqa: F401  httpx[http2], опционально
+    HTTP_VERSION = '2'  # Параллельные запросы рассылки идут по одному TLS-соединению
+except ImportError:
+    HTTP_VERSION = '1.1'
+
+# Фоновый поток, пишущий логи в файл и консоль (запускается в setup_logging)
+log_listener = None
+
+class FastRotatingFileHandler(RotatingFileHandler):
+    """RotatingFileHandler, который проверяет размер файла только вблизи maxBytes"""
+    
+    # Ближе этого к maxBytes размер проверяется штатно (форматирование + seek/tell)
+    ROLLOVER_MARGIN = 64 * 1024
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._known_size = None  # размер файла после последней записи
+    
+    def shouldRollover(self, record):
+        if self.maxBytes <= 0:
+            return 0
+        if self._known_size is not None and self._known_size < self.maxBytes - self.ROLLOVER_MARGIN:
+            return 0
+        return super().shouldRollover(record)
+    
+    def emit(self, record):
+        super().emit(record)
+        if self.stream is not None:
+            self._known_size = self.stream.tell()
+
 def setup_logging():
-    """Настраиваем продвинутое логирование"""
+    """Настраиваем продвинутое логирование (запись на диск - в фоновом потоке)"""
+    global log_listener
+    
     # Создаем папки
     os.makedirs("logs", exist_ok=True)
     
     # Формат логов с больше информации
     log_format = '%(asctime)s - %(name)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s'
     
-    # Настройка логирования с ротацией
-    from logging.handlers import RotatingFileHandler
-    
     # Ротирующий файловый хендлер (макс 10MB, 5 файлов)
-    file_handler = RotatingFileHandler(
+    file_handler = FastRotatingFileHandler(
         LOG_FILE, 
         maxBytes=10*1024*1024,  # 10MB
         backupCount=5,
@@ -37,11 +74,14 @@ def setup_logging():
     console_handler.setLevel(logging.INFO)
     console_handler.setFormatter(logging.Formatter(log_format))
     
-    # Настройка root logger
+    # Root logger только кладет записи в очередь, хендлеры работают в потоке слушателя
+    log_queue = queue.SimpleQueue()
+    log_listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    log_listener.start()
+    
     root_logger = logging.getLogger()
     root_logger.setLevel(logging.INFO)
-    root_logger.addHandler(file_handler)
-    root_logger.addHandler(console_handler)
+    root_logger.addHandler(QueueHandler(log_queue))
     
     # Уменьшаем логи от сторонних библиотек
     logging.getLogger("httpx").setLevel(logging.WARNING)
@@ -71,14 +111,22 @@ class OptimizedMatsavTovBot:
             
             # Создаем приложение
             self.logger.info("🔧 Создание приложения бота...")
-            self.application = Application.builder().token(BOT_TOKEN).build()
+            # Апдейты обрабатываются параллельно (не больше CONCURRENT_UPDATES),
+            # медленный обработчик не задерживает получение следующих.
+            # Бот и планировщик делят один пул соединений HTTPX (256 по умолчанию)
+            self.application = (
+                Application.builder()
+                .token(BOT_TOKEN)
+                .concurrent_updates(CONCURRENT_UPDATES)
+                .http_version(HTTP_VERSION)
+                .build()
+            )
             
             # Инициализируем планировщик
             self.logger.info("📅 Инициализация оптимизированного планировщика...")
             self.scheduler = OptimizedNotificationScheduler(self.application)
             
             # Устанавливаем глобальный планировщик для обработчиков
-            from bot_handlers_optimized import set_global_scheduler
             set_global_scheduler(self.scheduler)
             
             # Добавляем обработчики
@@ -94,11 +142,6 @@ class OptimizedMatsavTovBot:
         """Настраиваем обработчики команд"""
         self.logger.info("⚙️ Настройка обработчиков...")
         
-        from bot_handlers_optimized import (
-            start_command, text_message_handler, admin_stats_command,
-            admin_test_notification, admin_test_soon, admin_reschedule
-        )
-        
         # Пользовательские команды
         self.application.add_handler(CommandHandler("start", start_command))
         
@@ -176,6 +219,9 @@ class OptimizedMatsavTovBot:
                 await self.application.shutdown()
                 self.logger.info("✅ Приложение остановлено")
             
+            # Закрываем соединения с БД последними: ими пользуются и планировщик, и обработчики
+            await optimized_db.close()
+            
             self.logger.info("🏁 Корректная остановка завершена")
             
         except Exception as e:
@@ -184,17 +230,36 @@ class OptimizedMatsavTovBot:
         finally:
             self.shutdown_event.set()
     
+    def stop_logging(self):
+        """Дописываем оставшиеся в очереди логи и останавливаем поток логирования"""
+        global log_listener
+        if log_listener:
+            log_listener.stop()
+            log_listener = None
+    
+    def _request_stop(self, signum):
+        """Будим start(): остановку выполнит run_bot после выхода из него"""
+        self.logger.info("🛑 Получен сигнал %s", signum)
+        self.shutdown_event.set()
+    
     def setup_signal_handlers(self):
-        """Настраиваем обработчики сигналов"""
-        def signal_handler(signum, frame):
-            self.logger.info(f"🛑 Получен сигнал {signum}")
-            asyncio.create_task(self.stop())
-        
-        # Регистрируем обработчики сигналов (только для Unix)
-        if hasattr(signal, 'SIGTERM'):
-            signal.signal(signal.SIGTERM, signal_handler)
-        if hasattr(signal, 'SIGINT'):
-            signal.signal(signal.SIGINT, signal_handler)
+        """Настраиваем обработчики сигналов (вызывать внутри работающего цикла событий)"""
+        loop = asyncio.get_running_loop()
+        
+        for signame in ('SIGTERM', 'SIGINT'):
+            signum = getattr(signal, signame, None)
+            if signum is None:
+                continue
+            
+            try:
+                # Сигнал обрабатывается самим циклом событий
+                loop.add_signal_handler(signum, self._request_stop, signum)
+            except NotImplementedError:
+                # Windows: обычный обработчик, передаем событие в цикл потокобезопасно
+                signal.signal(
+                    signum,
+                    lambda received, frame: loop.call_soon_threadsafe(self._request_stop, received)
+                )
 
 async def run_bot():
     """Основная асинхронная функция"""
@@ -218,6 +283,7 @@ async def run_bot():
         
     finally:
         await bot.stop()
+        bot.stop_logging()
         print("\n👋 Оптимизированный бот остановлен!")
 
 def main():
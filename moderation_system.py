@@ -1,214 +1,383 @@
 # moderation_system.py - Расширенная система модерации для оптимизированного бота
 
 import asyncio
-import aiosqlite
+import html
 import logging
 import re
+import sqlite3
+import time
 from datetime import datetime, timedelta
 from typing import List, Dict, Optional, Tuple
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import ContextTypes, CallbackQueryHandler
 
 from config import ADMIN_ID, STOP_WORDS
+from database_optimized import optimized_db
+from security import admin_only
+
+try:
+    import ahocorasick  # pyahocorasick, опционально
+except ImportError:
+    ahocorasick = None
 
 logger = logging.getLogger(__name__)
 
+# Позитивные маркеры качества (ищутся как подстроки)
+QUALITY_MARKERS = (
+    'спасибо', 'благодарю', 'поддержка', 'сила', 'любовь', 'дружба',
+    'надежда', 'вера', 'мир', 'добро', 'счастье', 'радость', 'свет',
+    'тепло', 'улыбка', 'обнимаю', 'будет лучше', 'не сдавайся',
+    'держись', 'справишься', 'верю в тебя', 'ты сильный', 'пройдет'
+)
+
+# Признаки ссылок (компилируются один раз).
+# Для автоодобрения \w остается юникодным: "слово.слово" тоже считаем ссылкой
+_URL_RE = re.compile(r'https?://|www\.|\w+\.\w+')
+# Явные ссылки - для анализа в карточке модерации
+_LINK_RE = re.compile(r'https?://|www\.')
+
+_STOP_WORDS_LOWER = tuple(frozenset(word.lower() for word in STOP_WORDS if word))
+
+# UPDATE ... RETURNING поддерживается с SQLite 3.35
+_SQLITE_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# Типы совпадений в общем автомате
+_MATCH_STOP_WORD = 0
+_MATCH_MARKER = 1
+
+def _build_words_automaton():
+    """Один автомат Ахо-Корасик для стоп-слов и маркеров качества"""
+    if ahocorasick is None:
+        return None
+    
+    automaton = ahocorasick.Automaton()
+    for marker in QUALITY_MARKERS:
+        automaton.add_word(marker, (_MATCH_MARKER, marker))
+    # Стоп-слова добавляются последними: при совпадении с маркером важнее они
+    for stop_word in _STOP_WORDS_LOWER:
+        automaton.add_word(stop_word, (_MATCH_STOP_WORD, stop_word))
+    automaton.make_automaton()
+    return automaton
+
+# Строится один раз при импорте модуля
+_WORDS_AUTOMATON = _build_words_automaton()
+
+def scan_phrase_words(text_lower: str) -> Tuple[bool, int]:
+    """Один проход по тексту: (есть ли стоп-слова, сколько разных маркеров качества).
+    
+    Найдя стоп-слово, сразу возвращаем результат - маркеры тогда уже не важны.
+    """
+    if _WORDS_AUTOMATON is not None:
+        markers = set()
+        for _, (match_type, word) in _WORDS_AUTOMATON.iter(text_lower):
+            if match_type == _MATCH_STOP_WORD:
+                return True, len(markers)
+            markers.add(word)
+        return False, len(markers)
+    
+    has_stop_word = any(stop_word in text_lower for stop_word in _STOP_WORDS_LOWER)
+    return has_stop_word, sum(1 for marker in QUALITY_MARKERS if marker in text_lower)
+
+def analyze_phrase(text: str) -> Dict:
+    """Признаки фразы для автоодобрения и карточки модерации (все сканы текста - здесь)"""
+    has_stop_word, positive_score = scan_phrase_words(text.lower())
+    return {
+        'length': len(text),
+        'has_stop_word': has_stop_word,
+        'positive_score': positive_score,  # при стоп-слове может быть неполным
+        'has_url': _URL_RE.search(text) is not None,
+        'has_links': _LINK_RE.search(text) is not None,
+    }
+
+# Биты quality_bitmask в таблице phrases: признаки считаются один раз при сохранении,
+# автоодобрение фильтрует их в SQL. NULL - маска еще не посчитана (старые записи)
+QUALITY_BIT_URL = 1
+QUALITY_BIT_STOP_WORD = 2
+QUALITY_SCORE_SHIFT = 2
+QUALITY_SCORE_MAX = 63  # 6 бит под число маркеров
+
+# Условия автоодобрения (длина проверяется по тексту)
+_AUTO_APPROVE_MIN_LENGTH = 10
+_AUTO_APPROVE_MAX_LENGTH = 200
+_AUTO_APPROVE_MIN_SCORE = 2
+
+def quality_bitmask(analysis: Dict) -> int:
+    """Упаковываем признаки analyze_phrase в quality_bitmask"""
+    bitmask = min(analysis['positive_score'], QUALITY_SCORE_MAX) << QUALITY_SCORE_SHIFT
+    if analysis['has_url']:
+        bitmask |= QUALITY_BIT_URL
+    if analysis['has_stop_word']:
+        bitmask |= QUALITY_BIT_STOP_WORD
+    return bitmask
+
+def phrase_quality_bitmask(text: str) -> int:
+    """quality_bitmask для новой фразы"""
+    return quality_bitmask(analyze_phrase(text))
+
+def get_phrase_analysis(phrase: Dict) -> Dict:
+    """Анализ фразы из очереди: считается один раз и хранится в ее словаре"""
+    analysis = phrase.get('analysis')
+    if analysis is None:
+        analysis = phrase['analysis'] = analyze_phrase(phrase['text'])
+    return analysis
+
 class ModerationSystem:
     """Расширенная система модерации фраз"""
     
-    def __init__(self, db_path: str = "data/matsav_tov.db"):
-        self.db_path = db_path
+    def __init__(self):
+        # Соединения берутся из пула optimized_db: без открытия БД на каждый вызов
         self.current_moderation_session = {}  # user_id -> session_data
+        self._pending_cache = {}  # (limit, after) -> список фраз на модерации
+        self._pending_cache_version = None  # optimized_db.pending_version на момент заполнения
+        self._pending_count = None  # размер очереди, кэшируется вместе со страницами
+        self._stats_cache = None
+        self._stats_cache_timestamp = 0
+        self._stats_cache_ttl = 30  # секунд
+        
+    def invalidate_caches(self):
+        """Сбрасываем кэш очереди и статистики модерации (после одобрения/отклонения)"""
+        self._pending_cache.clear()
+        self._pending_count = None
+        self._stats_cache = None
+    
+    def _check_pending_version(self):
+        """Сбрасываем кэш очереди, если с тех пор пришли новые фразы"""
+        if self._pending_cache_version != optimized_db.pending_version:
+            self._pending_cache.clear()
+            self._pending_count = None
+            self._pending_cache_version = optimized_db.pending_version
+    
+    async def count_pending(self) -> int:
+        """Количество фраз на модерации (COUNT по покрывающему индексу статусов)"""
+        self._check_pending_version()
+        if self._pending_count is not None:
+            return self._pending_count
         
-    async def get_pending_phrases(self, limit: int = 10, offset: int = 0) -> List[Dict]:
-        """Получаем фразы на модерации"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                cursor = await db.execute("""
+            async with optimized_db.connection(read_only=True) as db:
+                cursor = await db.execute(
+                    "SELECT COUNT(*) FROM phrases WHERE status = 'pending'"
+                )
+                self._pending_count = (await cursor.fetchone())[0]
+                return self._pending_count
+                
+        except Exception as e:
+            logger.error("❌ Ошибка подсчета фраз на модерации: %s", e)
+            return 0
+    
+    async def get_pending_phrases(self, limit: int = 10,
+                                  after: Optional[Tuple[str, int]] = None) -> List[Dict]:
+        """Получаем фразы на модерации (из кэша, пока не пришли новые фразы).
+        
+        after - (created_at, id) последней показанной фразы: следующая страница
+        начинается сразу за ней (keyset-пагинация, без OFFSET).
+        """
+        self._check_pending_version()
+        
+        cached = self._pending_cache.get((limit, after))
+        if cached is not None:
+            return cached
+        
+        try:
+            async with optimized_db.connection(read_only=True) as db:
+                if after is None:
+                    after_clause, params = "", (limit,)
+                else:
+                    after_clause, params = "AND (p.created_at, p.id) > (?, ?)", (*after, limit)
+                
+                cursor = await db.execute(f"""
                     SELECT p.id, p.text, p.created_at, p.user_id, u.username
-                    FROM phrases p
+                    FROM phrases p INDEXED BY idx_phrases_pending_created
                     LEFT JOIN users u ON p.user_id = u.user_id
-                    WHERE p.status = 'pending'
-                    ORDER BY p.created_at ASC
-                    LIMIT ? OFFSET ?
-                """, (limit, offset))
+                    WHERE p.status = 'pending' {after_clause}
+                    ORDER BY p.created_at, p.id
+                    LIMIT ?
+                """, params)
                 
                 phrases = await cursor.fetchall()
                 
-                return [
-                    {
+                result = []
+                for phrase in phrases:
+                    username = phrase[4] or f"User_{phrase[3]}"
+                    result.append({
                         'id': phrase[0],
                         'text': phrase[1],
                         'created_at': phrase[2],
                         'user_id': phrase[3],
-                        'username': phrase[4] or f"User_{phrase[3]}"
-                    }
-                    for phrase in phrases
-                ]
+                        'username': username,
+                        # Экранируются один раз: страница очереди кэшируется
+                        'text_html': html.escape(phrase[1]),
+                        'username_html': html.escape(username),
+                    })
+                self._pending_cache[(limit, after)] = result
+                return result
                 
         except Exception as e:
-            logger.error(f"❌ Ошибка получения фраз на модерации: {e}")
+            logger.error("❌ Ошибка получения фраз на модерации: %s", e)
             return []
     
     async def get_moderation_stats(self) -> Dict:
-        """Получаем статистику модерации"""
+        """Получаем статистику модерации (с кэшированием)"""
+        if self._stats_cache and (time.monotonic() - self._stats_cache_timestamp) < self._stats_cache_ttl:
+            return self._stats_cache
+        
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                # Всего фраз на модерации
-                cursor = await db.execute("SELECT COUNT(*) FROM phrases WHERE status = 'pending'")
-                pending_count = (await cursor.fetchone())[0]
-                
-                # Одобренных фраз от пользователей
-                cursor = await db.execute("SELECT COUNT(*) FROM phrases WHERE status = 'active' AND source = 'user'")
-                approved_count = (await cursor.fetchone())[0]
-                
-                # Отклоненных фраз
-                cursor = await db.execute("SELECT COUNT(*) FROM phrases WHERE status = 'rejected'")
-                rejected_count = (await cursor.fetchone())[0]
-                
-                # Фразы за последние 24 часа
+            async with optimized_db.connection(read_only=True) as db:
+                # Все счетчики одним запросом; каждый подзапрос идет по своему индексу
                 cursor = await db.execute("""
-                    SELECT COUNT(*) FROM phrases 
-                    WHERE created_at > datetime('now', '-1 day') AND source = 'user'
+                    SELECT
+                        (SELECT COUNT(*) FROM phrases WHERE status = 'pending'),
+                        (SELECT COUNT(*) FROM phrases WHERE status = 'active' AND source = 'user'),
+                        (SELECT COUNT(*) FROM phrases WHERE status = 'rejected'),
+                        (SELECT COUNT(*) FROM phrases
+                         WHERE created_at > datetime('now', '-1 day') AND source = 'user')
                 """)
-                phrases_24h = (await cursor.fetchone())[0]
+                pending_count, approved_count, rejected_count, phrases_24h = await cursor.fetchone()
                 
-                # Топ активных пользователей по фразам
+                # Топ активных пользователей по фразам: считаем по phrases,
+                # к users присоединяем только пять найденных авторов
                 cursor = await db.execute("""
-                    SELECT u.username, COUNT(*) as phrase_count
-                    FROM phrases p
-                    JOIN users u ON p.user_id = u.user_id
-                    WHERE p.source = 'user'
-                    GROUP BY p.user_id
-                    ORDER BY phrase_count DESC
-                    LIMIT 5
+                    SELECT COALESCE(u.username, 'User_' || top.user_id), top.phrase_count
+                    FROM (
+                        SELECT user_id, COUNT(*) AS phrase_count
+                        FROM phrases
+                        WHERE source = 'user'
+                        GROUP BY user_id
+                        ORDER BY phrase_count DESC
+                        LIMIT 5
+                    ) AS top
+                    LEFT JOIN users u ON u.user_id = top.user_id
+                    ORDER BY top.phrase_count DESC
                 """)
                 top_contributors = await cursor.fetchall()
                 
-                return {
+                self._stats_cache = {
                     'pending': pending_count,
                     'approved': approved_count,
                     'rejected': rejected_count,
                     'phrases_24h': phrases_24h,
                     'top_contributors': [(user[0], user[1]) for user in top_contributors]
                 }
+                self._stats_cache_timestamp = time.monotonic()
+                
+                return self._stats_cache
                 
         except Exception as e:
-            logger.error(f"❌ Ошибка получения статистики модерации: {e}")
+            logger.error("❌ Ошибка получения статистики модерации: %s", e)
             return {}
     
-    async def approve_phrase(self, phrase_id: int, admin_id: int) -> bool:
-        """Одобряем фразу"""
-        try:
-            async with aiosqlite.connect(self.db_path) as db:
-                # Проверяем что фраза существует и на модерации
+    async def _set_pending_status(self, phrase_id: int, new_status: str) -> Optional[Tuple[str, int]]:
+        """Меняем статус фразы на модерации: (text, user_id) или None, если ее уже обработали"""
+        async with optimized_db.connection() as db:
+            if _SQLITE_HAS_RETURNING:
+                # Проверка и обновление одним запросом
+                cursor = await db.execute(
+                    "UPDATE phrases SET status = ? WHERE id = ? AND status = 'pending' RETURNING text, user_id",
+                    (new_status, phrase_id)
+                )
+                rows = await cursor.fetchall()
+                phrase_data = rows[0] if rows else None
+            else:
                 cursor = await db.execute(
                     "SELECT text, user_id FROM phrases WHERE id = ? AND status = 'pending'",
                     (phrase_id,)
                 )
                 phrase_data = await cursor.fetchone()
-                
-                if not phrase_data:
-                    logger.warning(f"⚠️ Фраза {phrase_id} не найдена или уже обработана")
-                    return False
-                
-                # Одобряем фразу
-                await db.execute(
-                    "UPDATE phrases SET status = 'active' WHERE id = ?",
-                    (phrase_id,)
-                )
-                
-                await db.commit()
-                
-                phrase_text, user_id = phrase_data
-                logger.info(f"✅ Админ {admin_id} одобрил фразу {phrase_id}: '{phrase_text[:50]}...' от пользователя {user_id}")
-                
-                return True
-                
+                if phrase_data:
+                    await db.execute(
+                        "UPDATE phrases SET status = ? WHERE id = ? AND status = 'pending'",
+                        (new_status, phrase_id)
+                    )
+            
+            await db.commit()
+        
+        if phrase_data:
+            self.invalidate_caches()
+        return phrase_data
+    
+    async def approve_phrase(self, phrase_id: int, admin_id: int) -> bool:
+        """Одобряем фразу"""
+        try:
+            phrase_data = await self._set_pending_status(phrase_id, 'active')
+            
+            if not phrase_data:
+                logger.warning("⚠️ Фраза %s не найдена или уже обработана", phrase_id)
+                return False
+            
+            # Набор активных фраз изменился
+            optimized_db.invalidate_phrase_cache()
+            
+            phrase_text, user_id = phrase_data
+            logger.info("✅ Админ %s одобрил фразу %s: '%.50s...' от пользователя %s", admin_id, phrase_id, phrase_text, user_id)
+            
+            return True
+            
         except Exception as e:
-            logger.error(f"❌ Ошибка одобрения фразы {phrase_id}: {e}")
+            logger.error("❌ Ошибка одобрения фразы %s: %s", phrase_id, e)
             return False
     
     async def reject_phrase(self, phrase_id: int, admin_id: int, reason: str = "") -> bool:
         """Отклоняем фразу"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                # Проверяем что фраза существует и на модерации
-                cursor = await db.execute(
-                    "SELECT text, user_id FROM phrases WHERE id = ? AND status = 'pending'",
-                    (phrase_id,)
-                )
-                phrase_data = await cursor.fetchone()
-                
-                if not phrase_data:
-                    logger.warning(f"⚠️ Фраза {phrase_id} не найдена или уже обработана")
-                    return False
-                
-                # Отклоняем фразу
-                await db.execute(
-                    "UPDATE phrases SET status = 'rejected' WHERE id = ?",
-                    (phrase_id,)
-                )
-                
-                await db.commit()
-                
-                phrase_text, user_id = phrase_data
-                logger.info(f"❌ Админ {admin_id} отклонил фразу {phrase_id}: '{phrase_text[:50]}...' от пользователя {user_id}. Причина: {reason}")
-                
-                return True
-                
+            phrase_data = await self._set_pending_status(phrase_id, 'rejected')
+            
+            if not phrase_data:
+                logger.warning("⚠️ Фраза %s не найдена или уже обработана", phrase_id)
+                return False
+            
+            phrase_text, user_id = phrase_data
+            logger.info("❌ Админ %s отклонил фразу %s: '%.50s...' от пользователя %s. Причина: %s",
+                        admin_id, phrase_id, phrase_text, user_id, reason)
+            
+            return True
+            
         except Exception as e:
-            logger.error(f"❌ Ошибка отклонения фразы {phrase_id}: {e}")
+            logger.error("❌ Ошибка отклонения фразы %s: %s", phrase_id, e)
             return False
     
     async def auto_approve_quality_phrases(self) -> int:
-        """Автоматически одобряем качественные фразы"""
+        """Автоматически одобряем качественные фразы (фильтр по quality_bitmask в SQL)"""
         try:
-            pending_phrases = await self.get_pending_phrases(limit=100)
-            approved_count = 0
+            async with optimized_db.connection() as db:
+                # Досчитываем маску для фраз, сохраненных до ее появления
+                cursor = await db.execute("""
+                    SELECT id, text FROM phrases INDEXED BY idx_phrases_pending_created
+                    WHERE status = 'pending' AND quality_bitmask IS NULL
+                """)
+                legacy_rows = await cursor.fetchall()
+                if legacy_rows:
+                    await db.executemany(
+                        "UPDATE phrases SET quality_bitmask = ? WHERE id = ?",
+                        [(phrase_quality_bitmask(text), phrase_id) for phrase_id, text in legacy_rows]
+                    )
+                
+                # Одобрение - один UPDATE без чтения фраз в Python
+                cursor = await db.execute("""
+                    UPDATE phrases SET status = 'active'
+                    WHERE status = 'pending'
+                      AND quality_bitmask & ? = 0
+                      AND (quality_bitmask >> ?) >= ?
+                      AND length(text) BETWEEN ? AND ?
+                """, (
+                    QUALITY_BIT_URL | QUALITY_BIT_STOP_WORD,
+                    QUALITY_SCORE_SHIFT, _AUTO_APPROVE_MIN_SCORE,
+                    _AUTO_APPROVE_MIN_LENGTH, _AUTO_APPROVE_MAX_LENGTH,
+                ))
+                approved_count = cursor.rowcount
+                if legacy_rows or approved_count:
+                    await db.commit()
             
-            for phrase in pending_phrases:
-                if self._is_high_quality_phrase(phrase['text']):
-                    success = await self.approve_phrase(phrase['id'], 0)  # 0 = автомодерация
-                    if success:
-                        approved_count += 1
+            if approved_count:
+                optimized_db.invalidate_phrase_cache()
+                self.invalidate_caches()
             
-            logger.info(f"🤖 Автоматически одобрено {approved_count} качественных фраз")
+            logger.info("🤖 Автоматически одобрено %d качественных фраз", approved_count)
             return approved_count
             
         except Exception as e:
-            logger.error(f"❌ Ошибка автоодобрения: {e}")
+            logger.error("❌ Ошибка автоодобрения: %s", e)
             return 0
     
-    def _is_high_quality_phrase(self, text: str) -> bool:
-        """Определяем высококачественные фразы для автоодобрения"""
-        # Быстрые проверки
-        if len(text) < 10 or len(text) > 200:
-            return False
-        
-        # Проверяем стоп-слова
-        text_lower = text.lower()
-        for stop_word in STOP_WORDS:
-            if stop_word in text_lower:
-                return False
-        
-        # Проверяем ссылки
-        if re.search(r'http[s]?://|www\.|\w+\.\w+', text):
-            return False
-        
-        # Позитивные маркеры качества
-        quality_markers = [
-            'спасибо', 'благодарю', 'поддержка', 'сила', 'любовь', 'дружба',
-            'надежда', 'вера', 'мир', 'добро', 'счастье', 'радость', 'свет',
-            'тепло', 'улыбка', 'обнимаю', 'будет лучше', 'не сдавайся',
-            'держись', 'справишься', 'верю в тебя', 'ты сильный', 'пройдет'
-        ]
-        
-        positive_score = sum(1 for marker in quality_markers if marker in text_lower)
-        
-        # Автоодобряем если есть несколько позитивных маркеров
-        return positive_score >= 2
-    
     def create_moderation_keyboard(self, phrase_id: int, current_index: int, total_count: int) -> InlineKeyboardMarkup:
         """Создаем клавиатуру для модерации"""
         keyboard = [
@@ -230,21 +399,86 @@ class ModerationSystem:
         
         return InlineKeyboardMarkup(keyboard)
 
-# Обработчики команд для интеграции в bot_handlers_optimized.py
+# Глобальный экземпляр: кэш очереди и сессии модерации живут между командами
+moderation_system = ModerationSystem()
 
-async def admin_moderate_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Команда модерации фраз"""
-    user = update.effective_user
-    user_id = user.id
+# Шаблоны сообщений статистики (разбираются один раз при импорте)
+_MODERATION_STATS_TEMPLATE = """📊 <b>СТАТИСТИКА МОДЕРАЦИИ</b>
+
+📋 <b>Фразы:</b>
+• На модерации: {pending}
+• Одобрено: {approved}
+• Отклонено: {rejected}
+• За 24 часа: {phrases_24h}
+
+👥 <b>Топ авторов фраз:</b>"""
+
+_MODERATION_SHORT_STATS_TEMPLATE = """📊 Статистика:
+• На модерации: {pending}
+• Одобрено: {approved}
+• Отклонено: {rejected}"""
+
+def _format_moderation_phrase(phrase: Dict) -> str:
+    """Карточка фразы на модерации (HTML)"""
+    analysis = get_phrase_analysis(phrase)
+    return f"""📝 <b>МОДЕРАЦИЯ ФРАЗЫ #{phrase['id']}</b>
+
+👤 <b>От:</b> {phrase['username_html']} (ID: {phrase['user_id']})
+📅 <b>Дата:</b> {phrase['created_at']}
+
+💬 <b>Текст:</b>
+"{phrase['text_html']}"
+
+🔍 <b>Анализ:</b>
+• Длина: {analysis['length']} символов
+• Содержит ссылки: {'Да' if analysis['has_links'] else 'Нет'}
+• Подозрительные слова: {'Да' if analysis['has_stop_word'] else 'Нет'}"""
+
+async def _navigate_moderation(query, user_id: int, step: int):
+    """Показываем следующую (step=1) или предыдущую (step=-1) фразу очереди"""
+    session = moderation_system.current_moderation_session.get(user_id)
+    if session is None:
+        await query.edit_message_text("⌛ Сессия модерации устарела, начните заново: /moderate")
+        return
     
-    if user_id != ADMIN_ID:
-        await update.message.reply_text("У вас нет доступа к этой команде.")
+    index = session['current_index'] + step
+    if index < 0:
         return
     
-    moderation = ModerationSystem()
+    # Следующая - сразу за показанной; предыдущая - по сохраненному курсору
+    after = session['next_cursor'] if step > 0 else session['cursors'][index]
+    pending_phrases, total_count = await asyncio.gather(
+        moderation_system.get_pending_phrases(limit=1, after=after),
+        moderation_system.count_pending()
+    )
+    if not pending_phrases:
+        return  # Дальше фраз нет - карточка остается
+    
+    phrase = pending_phrases[0]
+    session['current_index'] = index
+    session['cursors'][index:] = [after]
+    session['next_cursor'] = (phrase['created_at'], phrase['id'])
+    session['total_count'] = total_count
+    
+    keyboard = moderation_system.create_moderation_keyboard(phrase['id'], index, total_count)
+    await query.edit_message_text(
+        _format_moderation_phrase(phrase),
+        reply_markup=keyboard,
+        parse_mode='HTML'
+    )
+
+# Обработчики команд для интеграции в bot_handlers_optimized.py
+
+@admin_only
+async def admin_moderate_command(update: Update, context: ContextTypes.DEFAULT_TYPE, user):
+    """Команда модерации фраз"""
+    user_id = user.id
     
-    # Получаем фразы на модерации
-    pending_phrases = await moderation.get_pending_phrases(limit=1)
+    # Первая фраза и общее количество на модерации - параллельными запросами
+    pending_phrases, total_count = await asyncio.gather(
+        moderation_system.get_pending_phrases(limit=1),
+        moderation_system.count_pending()
+    )
     
     if not pending_phrases:
         await update.message.reply_text("🎉 Нет фраз на модерации!")
@@ -252,85 +486,59 @@ async def admin_moderate_command(update: Update, context: ContextTypes.DEFAULT_T
     
     phrase = pending_phrases[0]
     
-    # Сохраняем сессию модерации
-    moderation.current_moderation_session[user_id] = {
+    # Сохраняем сессию модерации: навигация идет по курсорам (created_at, id)
+    moderation_system.current_moderation_session[user_id] = {
         'current_index': 0,
-        'total_count': len(await moderation.get_pending_phrases(limit=1000))  # Получаем общее количество
+        'cursors': [None],  # after, по которому получена каждая показанная фраза
+        'next_cursor': (phrase['created_at'], phrase['id']),  # after для следующей фразы
+        'total_count': total_count
     }
     
-    # Формируем сообщение
-    message_text = f"""📝 **МОДЕРАЦИЯ ФРАЗЫ #{phrase['id']}**
-
-👤 **От:** {phrase['username']} (ID: {phrase['user_id']})
-📅 **Дата:** {phrase['created_at']}
-
-💬 **Текст:**
-"{phrase['text']}"
-
-🔍 **Анализ:**
-• Длина: {len(phrase['text'])} символов
-• Содержит ссылки: {'Да' if re.search(r'http[s]?://|www\.', phrase['text']) else 'Нет'}
-• Подозрительные слова: {'Да' if any(word in phrase['text'].lower() for word in STOP_WORDS) else 'Нет'}"""
-    
-    keyboard = moderation.create_moderation_keyboard(phrase['id'], 0, moderation.current_moderation_session[user_id]['total_count'])
+    keyboard = moderation_system.create_moderation_keyboard(phrase['id'], 0, total_count)
     
     await update.message.reply_text(
-        message_text,
+        _format_moderation_phrase(phrase),
         reply_markup=keyboard,
-        parse_mode='Markdown'
+        parse_mode='HTML'
     )
     
-    logger.info(f"👑 Админ {user.first_name} начал модерацию")
+    logger.info("👑 Админ %s начал модерацию", user.first_name)
 
-async def admin_moderation_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@admin_only
+async def admin_moderation_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE, user):
     """Статистика модерации"""
-    user = update.effective_user
-    user_id = user.id
-    
-    if user_id != ADMIN_ID:
-        await update.message.reply_text("У вас нет доступа к этой команде.")
-        return
-    
-    moderation = ModerationSystem()
-    stats = await moderation.get_moderation_stats()
-    
-    message = f"""📊 **СТАТИСТИКА МОДЕРАЦИИ**
-
-📋 **Фразы:**
-• На модерации: {stats.get('pending', 0)}
-• Одобрено: {stats.get('approved', 0)}
-• Отклонено: {stats.get('rejected', 0)}
-• За 24 часа: {stats.get('phrases_24h', 0)}
-
-👥 **Топ авторов фраз:**"""
-    
-    for i, (username, count) in enumerate(stats.get('top_contributors', []), 1):
-        message += f"\n{i}. {username}: {count} фраз"
-    
-    if not stats.get('top_contributors'):
-        message += "\nПока нет данных"
-    
-    await update.message.reply_text(message, parse_mode='Markdown')
+    stats = await moderation_system.get_moderation_stats()
+    
+    parts = [_MODERATION_STATS_TEMPLATE.format_map({
+        'pending': stats.get('pending', 0),
+        'approved': stats.get('approved', 0),
+        'rejected': stats.get('rejected', 0),
+        'phrases_24h': stats.get('phrases_24h', 0),
+    })]
+    
+    top_contributors = stats.get('top_contributors')
+    if top_contributors:
+        parts.extend(
+            f"{i}. {html.escape(username)}: {count} фраз"
+            for i, (username, count) in enumerate(top_contributors, 1)
+        )
+    else:
+        parts.append("Пока нет данных")
+    
+    await update.message.reply_text("\n".join(parts), parse_mode='HTML')
 
-async def admin_auto_approve_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@admin_only
+async def admin_auto_approve_command(update: Update, context: ContextTypes.DEFAULT_TYPE, user):
     """Автоматическое одобрение качественных фраз"""
-    user = update.effective_user
-    user_id = user.id
-    
-    if user_id != ADMIN_ID:
-        await update.message.reply_text("У вас нет доступа к этой команде.")
-        return
-    
     await update.message.reply_text("🤖 Запускаю автоматическое одобрение...")
     
-    moderation = ModerationSystem()
-    approved_count = await moderation.auto_approve_quality_phrases()
+    approved_count = await moderation_system.auto_approve_quality_phrases()
     
     await update.message.reply_text(
         f"✅ Автоматически одобрено {approved_count} качественных фраз!"
     )
     
-    logger.info(f"👑 Админ {user.first_name} запустил автоодобрение: {approved_count} фраз")
+    logger.info("👑 Админ %s запустил автоодобрение: %d фраз", user.first_name, approved_count)
 
 async def moderation_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопок модерации"""
@@ -344,12 +552,11 @@ async def moderation_callback_handler(update: Update, context: ContextTypes.DEFA
     await query.answer()
     
     data = query.data
-    moderation = ModerationSystem()
     
     try:
         if data.startswith("mod_approve_"):
             phrase_id = int(data.split("_")[2])
-            success = await moderation.approve_phrase(phrase_id, user_id)
+            success = await moderation_system.approve_phrase(phrase_id, user_id)
             
             if success:
                 await query.edit_message_text("✅ Фраза одобрена!")
@@ -358,7 +565,7 @@ async def moderation_callback_handler(update: Update, context: ContextTypes.DEFA
         
         elif data.startswith("mod_reject_"):
             phrase_id = int(data.split("_")[2])
-            success = await moderation.reject_phrase(phrase_id, user_id, "Отклонено админом")
+            success = await moderation_system.reject_phrase(phrase_id, user_id, "Отклонено админом")
             
             if success:
                 await query.edit_message_text("❌ Фраза отклонена!")
@@ -366,26 +573,32 @@ async def moderation_callback_handler(update: Update, context: ContextTypes.DEFA
                 await query.edit_message_text("❌ Ошибка при отклонении фразы.")
         
         elif data == "mod_stats":
-            stats = await moderation.get_moderation_stats()
-            stats_text = f"""📊 Статистика:
-• На модерации: {stats.get('pending', 0)}
-• Одобрено: {stats.get('approved', 0)}
-• Отклонено: {stats.get('rejected', 0)}"""
+            stats = await moderation_system.get_moderation_stats()
+            stats_text = _MODERATION_SHORT_STATS_TEMPLATE.format_map({
+                'pending': stats.get('pending', 0),
+                'approved': stats.get('approved', 0),
+                'rejected': stats.get('rejected', 0),
+            })
             
             await query.edit_message_text(stats_text)
         
         elif data == "mod_auto_approve":
             await query.edit_message_text("🤖 Запуск автоодобрения...")
-            approved_count = await moderation.auto_approve_quality_phrases()
+            approved_count = await moderation_system.auto_approve_quality_phrases()
             await query.edit_message_text(f"✅ Автоодобрено: {approved_count} фраз")
         
+        elif data.startswith("mod_next_"):
+            await _navigate_moderation(query, user_id, 1)
+        
+        elif data.startswith("mod_prev_"):
+            await _navigate_moderation(query, user_id, -1)
+        
         elif data == "mod_close":
+            moderation_system.current_moderation_session.pop(user_id, None)
             await query.edit_message_text("❌ Модерация закрыта.")
         
-        # Навигация между фразами можно добавить позже
-        
     except Exception as e:
-        logger.error(f"❌ Ошибка в обработчике модерации: {e}")
+        logger.error("❌ Ошибка в обработчике модерации: %s", e)
         await query.edit_message_text("❌ Произошла ошибка.")
 
 # Функция для добавления обработчиков в main_optimized.py
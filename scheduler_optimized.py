@@ -1,12 +1,17 @@
 # scheduler_optimized.py - Оптимизированный планировщик рассылки
 
 import asyncio
+import functools
+import heapq
+import json
 import logging
+import os
 import random
 from datetime import datetime, time, timedelta
 from typing import List, Dict, Optional
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.date import DateTrigger
 from telegram.error import TelegramError, Forbidden, ChatMigrated, RetryAfter
 import time as time_module
 
@@ -15,6 +20,68 @@ from database_optimized import optimized_db
 
 logger = logging.getLogger(__name__)
 
+# Размер батча, подобранный во время рассылок, переживает перезапуск
+SCHEDULER_STATE_FILE = "data/scheduler_state.json"
+
+# Задача тестовой рассылки (одна, перезаписывается)
+TEST_JOB_ID = "test_notification_scheduled"
+
+# Ошибки Telegram, после которых писать пользователю бесполезно
+_INACTIVE_ERROR_MARKERS = ('blocked', 'chat not found', 'deactivated')
+
+class TokenBucket:
+    """Ограничитель скорости: не больше rate операций в секунду, всплеск до capacity.
+    
+    После RetryAfter (penalize) ставит паузу и снижает темп, затем линейно возвращает его.
+    """
+    
+    def __init__(self, rate: float, capacity: Optional[float] = None,
+                 penalty_factor: float = 0.7, recovery_time: float = 30.0):
+        self.base_rate = rate
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.min_rate = rate * 0.1
+        self.penalty_factor = penalty_factor
+        self.recovery_per_second = rate / recovery_time  # Восстановление темпа
+        self._tokens = self.capacity
+        self._last_refill = time_module.monotonic()
+        self._paused_until = 0.0
+        self._lock = None  # asyncio.Lock, создается внутри цикла событий
+    
+    def penalize(self, retry_after: float):
+        """Telegram ответил RetryAfter: ждем retry_after и снижаем темп"""
+        paused_until = time_module.monotonic() + retry_after
+        if paused_until > self._paused_until:
+            self._paused_until = paused_until
+            # Токены не копятся во время паузы - без всплеска после нее
+            self._last_refill = paused_until
+        self._tokens = 0
+        self.rate = max(self.min_rate, self.rate * self.penalty_factor)
+    
+    async def acquire(self):
+        """Ждем свободный токен (ожидающие обслуживаются по очереди)"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        
+        async with self._lock:
+            while True:
+                now = time_module.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                
+                elapsed = now - self._last_refill
+                self._last_refill = now
+                if self.rate < self.base_rate:
+                    self.rate = min(self.base_rate, self.rate + elapsed * self.recovery_per_second)
+                self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+                
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
 class OptimizedNotificationScheduler:
     """Оптимизированный планировщик рассылки для большого количества пользователей"""
     
@@ -32,14 +99,58 @@ class OptimizedNotificationScheduler:
         }
         
         # Настройки для оптимизации
-        self.batch_size = 50  # Размер батча для рассылки
-        self.batch_delay = 0.5  # Задержка между батчами (секунды)
-        self.message_delay = 0.03  # Задержка между сообщениями (30ms)
+        self.batch_size = 50  # Размер батча для рассылки (подстраивается, AIMD)
+        self.min_batch_size = 10
+        self.max_batch_size = 200
+        self._retry_after_count = 0  # Сколько раз Telegram ответил RetryAfter
+        # Время ответа send_message без ожидания ограничителя (сумма и число замеров)
+        self._send_time_total = 0.0
+        self._send_time_count = 0
+        self.messages_per_second = 28  # Общий темп отправки (лимит Telegram ~30 сообщений/с)
+        self.rate_limiter = TokenBucket(self.messages_per_second, capacity=30)
+        self.max_concurrent_sends = 25  # Одновременных запросов к Telegram
+        self._send_semaphore = None  # asyncio.Semaphore, создается внутри цикла событий
         self.max_retries = 3
         self.retry_delay = 300  # 5 минут между повторными попытками
+        # Отложенные повторы после RetryAfter: (срок по time.monotonic, user_id, фраза, попытка)
+        self._retry_heap = []
+        # id задач рассылок на день: вместо перебора всех задач через get_jobs()
+        self._daily_job_ids = set()
+        
+        self._load_state()
         
         logger.info("📅 Оптимизированный планировщик инициализирован")
     
+    def _load_state(self):
+        """Загружаем подобранный размер батча"""
+        try:
+            if os.path.exists(SCHEDULER_STATE_FILE):
+                with open(SCHEDULER_STATE_FILE, 'r', encoding='utf-8') as f:
+                    batch_size = json.load(f).get('batch_size', self.batch_size)
+                self.batch_size = max(self.min_batch_size, min(self.max_batch_size, int(batch_size)))
+        except Exception as e:
+            logger.error(f"❌ Ошибка загрузки состояния планировщика: {e}")
+    
+    def _save_state(self):
+        """Сохраняем подобранный размер батча"""
+        try:
+            os.makedirs("data", exist_ok=True)
+            with open(SCHEDULER_STATE_FILE, 'w', encoding='utf-8') as f:
+                json.dump({'batch_size': self.batch_size}, f)
+        except Exception as e:
+            logger.error(f"❌ Ошибка сохранения состояния планировщика: {e}")
+    
+    def _adapt_batch_size(self, avg_send_time: Optional[float], had_retry_after: bool):
+        """AIMD: после RetryAfter батч уменьшаем вдвое, при быстрых ответах Telegram - растим на 25%"""
+        if had_retry_after:
+            self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+            return
+        
+        # Ответы быстрые, если max_concurrent_sends запросов успевают за темпом ограничителя
+        fast_send_time = self.max_concurrent_sends / self.messages_per_second
+        if avg_send_time is not None and avg_send_time < fast_send_time:
+            self.batch_size = min(self.max_batch_size, int(self.batch_size * 1.25))
+    
     def start(self):
         """Запускаем планировщик"""
         try:
@@ -53,13 +164,26 @@ class OptimizedNotificationScheduler:
             self.scheduler.start()
             
             logger.info("✅ Оптимизированный планировщик запущен")
-            logger.info(f"🎯 Настройки: батч {self.batch_size}, задержка {self.batch_delay}с")
+            logger.info(f"🎯 Настройки: батч {self.batch_size}, темп {self.messages_per_second} сообщений/с")
             
         except Exception as e:
             logger.error(f"❌ Ошибка запуска планировщика: {e}")
     
     def schedule_daily_notifications(self):
-        """Планируем ежедневные рассылки"""
+        """Планируем ежедневные рассылки: каждую ночь составляем новое расписание на день"""
+        self.scheduler.add_job(
+            self._plan_today,
+            trigger=CronTrigger(hour=0, minute=5),
+            id="daily_planner",
+            replace_existing=True,
+            max_instances=1
+        )
+        
+        # Расписание на сегодня - сразу при запуске
+        self._plan_today()
+    
+    def _plan_today(self):
+        """Случайное время рассылок на сегодня: разовые задачи, удаляются после запуска"""
         
         # Временные интервалы для рассылок
         time_slots = [
@@ -73,24 +197,32 @@ class OptimizedNotificationScheduler:
             (21, 23),  # Поздний вечер
         ]
         
+        now = datetime.now()
+        today = now.date()
+        
         # Планируем нужное количество рассылок
         used_slots = random.sample(time_slots, min(DAILY_NOTIFICATIONS, len(time_slots)))
         
         for i, (start_hour, end_hour) in enumerate(used_slots):
-            # Случайное время в интервале
-            random_hour = random.randint(start_hour, end_hour - 1)
-            random_minute = random.randint(0, 59)
+            # Случайная минута, равномерно по всему интервалу
+            minute_of_day = random.randrange(start_hour * 60, end_hour * 60)
+            run_date = datetime.combine(today, time(minute_of_day // 60, minute_of_day % 60))
+            
+            if run_date <= now:
+                continue  # Бот запущен после этого времени
             
             # Добавляем задачу
+            job_id = f"daily_notification_{today:%Y%m%d}_{i}"
             self.scheduler.add_job(
                 self.send_batch_notification,
-                trigger=CronTrigger(hour=random_hour, minute=random_minute),
-                id=f"daily_notification_{i}",
+                trigger=DateTrigger(run_date=run_date),
+                id=job_id,
                 replace_existing=True,
                 max_instances=1
             )
+            self._daily_job_ids.add(job_id)
             
-            logger.info(f"📅 Рассылка #{i+1} запланирована на {random_hour:02d}:{random_minute:02d}")
+            logger.info(f"📅 Рассылка #{i+1} запланирована на {run_date:%H:%M}")
     
     def schedule_retry_failed_notifications(self):
         """Планируем повторные попытки отправки"""
@@ -111,50 +243,63 @@ class OptimizedNotificationScheduler:
             return
         
         self.is_sending = True
-        start_time = time_module.time()
+        start_time = time_module.monotonic()
         
         try:
-            # Получаем пользователей и фразу
-            users = await optimized_db.get_active_users()
+            # Получаем фразу; пользователей читаем из БД по батчу, не всех сразу
             phrase = await optimized_db.get_random_phrase()
             
-            if not users:
-                logger.warning("👥 Нет активных пользователей для рассылки")
-                return
-            
             if not phrase:
                 logger.error("💬 Не удалось получить фразу для рассылки")
                 return
             
-            # Логируем начало рассылки
-            self.notification_count += 1
-            total_users = len(users)
-            
-            logger.info(f"📤 Рассылка #{self.notification_count} начата")
-            logger.info(f"👥 Получателей: {total_users}")
-            logger.info(f"💌 Фраза: '{phrase[:50]}...'")
-            
-            # Разбиваем пользователей на батчи
-            batches = [users[i:i + self.batch_size] for i in range(0, len(users), self.batch_size)]
-            
             sent_count = 0
             failed_count = 0
-            
-            # Отправляем батчами
-            for batch_num, batch_users in enumerate(batches, 1):
-                logger.info(f"📦 Обрабатываем батч {batch_num}/{len(batches)} ({len(batch_users)} пользователей)")
+            batch_num = 0
+            initial_batch_size = self.batch_size
+            
+            # Отправляем батчами; размер батча меняется прямо по ходу рассылки
+            async for batch_users in optimized_db.iter_active_users(lambda: self.batch_size):
+                if batch_num == 0:
+                    # Логируем начало рассылки
+                    self.notification_count += 1
+                    logger.info(f"📤 Рассылка #{self.notification_count} начата")
+                    logger.info(f"💌 Фраза: '{phrase[:50]}...'")
+                
+                batch_num += 1
+                logger.info(f"📦 Обрабатываем батч {batch_num} ({len(batch_users)} пользователей)")
                 
                 # Отправляем батч
+                retry_after_before = self._retry_after_count
+                send_time_before = self._send_time_total
+                send_count_before = self._send_time_count
                 batch_sent, batch_failed = await self._send_batch(batch_users, phrase)
                 sent_count += batch_sent
                 failed_count += batch_failed
                 
-                # Задержка между батчами (кроме последнего)
-                if batch_num < len(batches):
-                    await asyncio.sleep(self.batch_delay)
+                batch_send_count = self._send_time_count - send_count_before
+                self._adapt_batch_size(
+                    (self._send_time_total - send_time_before) / batch_send_count if batch_send_count else None,
+                    self._retry_after_count > retry_after_before
+                )
+            
+            if self.batch_size != initial_batch_size:
+                logger.info(f"📐 Размер батча: {initial_batch_size} -> {self.batch_size}")
+                self._save_state()
+            
+            # Повторы после RetryAfter: дожидаемся их сроков, итоги входят в эту рассылку
+            retry_sent, retry_failed = await self._drain_retries()
+            sent_count += retry_sent
+            failed_count += retry_failed
+            
+            if batch_num == 0:
+                logger.warning("👥 Нет активных пользователей для рассылки")
+                return
+            
+            logger.info(f"👥 Получателей: {sent_count + failed_count}")
             
             # Обновляем статистику
-            elapsed_time = time_module.time() - start_time
+            elapsed_time = time_module.monotonic() - start_time
             self.stats['total_sent'] += sent_count
             self.stats['total_failed'] += failed_count
             self.stats['last_batch_time'] = elapsed_time
@@ -178,97 +323,139 @@ class OptimizedNotificationScheduler:
         finally:
             self.is_sending = False
     
-    async def _send_batch(self, user_ids: List[int], phrase: str) -> tuple[int, int]:
-        """Отправляем батч пользователям"""
-        sent_count = 0
-        failed_count = 0
-        
-        # Создаем задачи для параллельной отправки
-        tasks = []
-        for user_id in user_ids:
-            task = asyncio.create_task(self._send_to_user(user_id, phrase))
-            tasks.append(task)
+    async def _send_batch(self, user_ids: List[int], phrase: str, attempt: int = 0) -> tuple[int, int]:
+        """Отправляем батч пользователям: (отправлено, ошибок); отложенные повторы не считаются"""
+        # Фраза и попытка общие для всего батча - связываем один раз
+        send = functools.partial(self._send_to_user, phrase=phrase, attempt=attempt)
         
-        # Ждем выполнения всех задач
-        results = await asyncio.gather(*tasks, return_exceptions=True)
+        # Ошибки отправки _send_to_user перехватывает сам, но ожидание семафора
+        # и ограничителя вне его try: исключение не должно терять итоги всего батча
+        results = await asyncio.gather(*(send(user_id) for user_id in user_ids), return_exceptions=True)
+        sent_count = sum(result is True for result in results)
+        deferred_count = sum(result is None for result in results)
         
-        # Обрабатываем результаты
-        for user_id, result in zip(user_ids, results):
-            if isinstance(result, Exception):
-                failed_count += 1
-                logger.error(f"❌ Ошибка отправки пользователю {user_id}: {result}")
-            elif result:
-                sent_count += 1
-            else:
-                failed_count += 1
-        
-        return sent_count, failed_count
+        return sent_count, len(results) - sent_count - deferred_count
     
-    async def _send_to_user(self, user_id: int, phrase: str) -> bool:
-        """Отправляем сообщение одному пользователю"""
-        try:
-            await self.bot.send_message(
-                chat_id=user_id,
-                text=phrase
-            )
-            
-            # Логируем успешную отправку
-            await optimized_db.log_notification(user_id, 0, 'sent')
-            
-            # Небольшая задержка для соблюдения лимитов Telegram
-            await asyncio.sleep(self.message_delay)
-            
-            return True
-            
-        except Forbidden:
-            # Пользователь заблокировал бота
-            await optimized_db.mark_user_inactive(user_id)
-            logger.info(f"🚫 Пользователь {user_id} заблокировал бота")
-            return False
-            
-        except RetryAfter as e:
-            # Превышен лимит - ждем
-            wait_time = min(e.retry_after, 60)  # Максимум минута
-            logger.warning(f"⏰ Rate limit для {user_id}, ждем {wait_time}с")
-            await asyncio.sleep(wait_time)
-            
-            # Повторная попытка
+    async def _send_to_user(self, user_id: int, phrase: str, attempt: int = 0) -> Optional[bool]:
+        """Отправляем сообщение одному пользователю (None - повтор отложен в _retry_heap)"""
+        if self._send_semaphore is None:
+            self._send_semaphore = asyncio.Semaphore(self.max_concurrent_sends)
+        
+        # Одновременно в сети не больше max_concurrent_sends запросов
+        async with self._send_semaphore:
             try:
-                await self.bot.send_message(chat_id=user_id, text=phrase)
+                # Темп задает общий ограничитель, а не пауза после каждого сообщения
+                await self.rate_limiter.acquire()
+                send_start = time_module.monotonic()
+                await self.bot.send_message(
+                    chat_id=user_id,
+                    text=phrase
+                )
+                self._send_time_total += time_module.monotonic() - send_start
+                self._send_time_count += 1
+                
+                # Логируем успешную отправку
                 await optimized_db.log_notification(user_id, 0, 'sent')
+                
                 return True
-            except Exception as retry_error:
-                await optimized_db.log_notification(user_id, 0, 'failed', str(retry_error))
-                return False
-            
-        except ChatMigrated as e:
-            # Чат мигрировал - обновляем ID
-            new_chat_id = e.new_chat_id
-            logger.info(f"📱 Чат мигрировал: {user_id} -> {new_chat_id}")
-            return False
-            
-        except TelegramError as e:
-            # Другие ошибки Telegram
-            error_msg = str(e)
-            await optimized_db.log_notification(user_id, 0, 'failed', error_msg)
-            
-            if "blocked" in error_msg.lower():
+                
+            except Forbidden:
+                # Пользователь заблокировал бота
                 await optimized_db.mark_user_inactive(user_id)
-            
-            return False
-            
-        except Exception as e:
-            # Неожиданные ошибки
-            await optimized_db.log_notification(user_id, 0, 'failed', str(e))
-            logger.error(f"❌ Неожиданная ошибка при отправке {user_id}: {e}")
-            return False
+                logger.info("🚫 Пользователь %s заблокировал бота", user_id)
+                return False
+                
+            except RetryAfter as e:
+                # Превышен лимит - пауза для всех отправок и снижение темпа
+                wait_time = min(e.retry_after, 60)  # Максимум минута
+                logger.warning("⏰ Rate limit для %s, повтор через %sс", user_id, wait_time)
+                self.rate_limiter.penalize(wait_time)
+                self._retry_after_count += 1
+                
+                # Повтор откладываем: батч не ждет этого пользователя
+                if attempt < self.max_retries:
+                    heapq.heappush(
+                        self._retry_heap,
+                        (time_module.monotonic() + wait_time, user_id, phrase, attempt + 1)
+                    )
+                    self.stats['retry_queue_size'] = len(self._retry_heap)
+                    return None
+                
+                # Попытки кончились
+                await optimized_db.log_notification(user_id, 0, 'failed', str(e))
+                return False
+                
+            except ChatMigrated as e:
+                # Чат мигрировал - обновляем ID
+                new_chat_id = e.new_chat_id
+                logger.info("📱 Чат мигрировал: %s -> %s", user_id, new_chat_id)
+                return False
+                
+            except TelegramError as e:
+                # Другие ошибки Telegram
+                error_msg = str(e)
+                await optimized_db.log_notification(user_id, 0, 'failed', error_msg)
+                
+                error_lower = error_msg.lower()
+                if any(marker in error_lower for marker in _INACTIVE_ERROR_MARKERS):
+                    await optimized_db.mark_user_inactive(user_id)
+                
+                return False
+                
+            except Exception as e:
+                # Неожиданные ошибки
+                await optimized_db.log_notification(user_id, 0, 'failed', str(e))
+                logger.error("❌ Неожиданная ошибка при отправке %s: %s", user_id, e)
+                return False
+    
+    async def _retry_due(self) -> tuple[int, int]:
+        """Повторяем отложенные отправки, срок которых наступил: (отправлено, ошибок)"""
+        now = time_module.monotonic()
+        due = {}  # (фраза, попытка) -> список user_id
+        while self._retry_heap and self._retry_heap[0][0] <= now:
+            _, user_id, phrase, attempt = heapq.heappop(self._retry_heap)
+            due.setdefault((phrase, attempt), []).append(user_id)
+        self.stats['retry_queue_size'] = len(self._retry_heap)
+        
+        sent_count = 0
+        failed_count = 0
+        for (phrase, attempt), user_ids in due.items():
+            batch_sent, batch_failed = await self._send_batch(user_ids, phrase, attempt)
+            sent_count += batch_sent
+            failed_count += batch_failed
+        
+        return sent_count, failed_count
+    
+    async def _drain_retries(self) -> tuple[int, int]:
+        """Ждем и выполняем все отложенные повторы (их число ограничено max_retries)"""
+        sent_count = 0
+        failed_count = 0
+        while self._retry_heap:
+            delay = self._retry_heap[0][0] - time_module.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            
+            batch_sent, batch_failed = await self._retry_due()
+            sent_count += batch_sent
+            failed_count += batch_failed
+        
+        return sent_count, failed_count
     
     async def retry_failed_notifications(self):
-        """Повторная отправка неудачных уведомлений"""
+        """Повторная отправка уведомлений, отложенных после RetryAfter"""
+        # Во время рассылки повторы выполняет она сама
+        if self.is_sending:
+            return
+        
         try:
-            # Здесь можно добавить логику получения неудачных уведомлений из БД
-            # и их повторную отправку
-            logger.debug("🔄 Проверка неудачных уведомлений")
+            sent_count, failed_count = await self._retry_due()
+            if not sent_count and not failed_count:
+                logger.debug("🔄 Проверка неудачных уведомлений")
+                return
+            
+            self.stats['total_sent'] += sent_count
+            self.stats['total_failed'] += failed_count
+            logger.info(f"🔄 Повторно отправлено {sent_count}, ошибок {failed_count}")
             
         except Exception as e:
             logger.error(f"❌ Ошибка повторной отправки: {e}")
@@ -279,7 +466,7 @@ class OptimizedNotificationScheduler:
             phrase = await optimized_db.get_random_phrase()
             test_message = f"🧪 ТЕСТ: {phrase}"
             
-            success = await self._send_to_user(user_id, test_message)
+            success = await self._send_to_user(user_id, test_message) is True
             
             if success:
                 logger.info(f"✅ Тестовое уведомление отправлено {user_id}")
@@ -302,7 +489,7 @@ class OptimizedNotificationScheduler:
                 hour=test_time.hour,
                 minute=test_time.minute
             ),
-            id="test_notification_scheduled",
+            id=TEST_JOB_ID,
             replace_existing=True,
             max_instances=1
         )
@@ -311,16 +498,30 @@ class OptimizedNotificationScheduler:
         logger.info(f"🧪 Тестовая рассылка запланирована на {time_str}")
         return time_str
     
+    def _daily_jobs(self) -> List:
+        """Задачи рассылок на день (выполненные разовые задачи убираем из набора)"""
+        jobs = []
+        # Копия: _plan_today может дополнять набор из потока планировщика
+        for job_id in list(self._daily_job_ids):
+            job = self.scheduler.get_job(job_id)
+            if job is None:
+                self._daily_job_ids.discard(job_id)
+            else:
+                jobs.append(job)
+        return jobs
+    
     def get_next_notifications(self) -> List[str]:
         """Получаем следующие запланированные рассылки"""
         try:
-            jobs = self.scheduler.get_jobs()
-            next_times = []
+            jobs = self._daily_jobs()
+            test_job = self.scheduler.get_job(TEST_JOB_ID)
+            if test_job is not None:
+                jobs.append(test_job)
             
+            next_times = []
             for job in jobs:
-                if job.id.startswith("daily_notification") or "test" in job.id:
-                    if job.next_run_time:
-                        next_times.append(job.next_run_time.strftime("%H:%M"))
+                if job.next_run_time:
+                    next_times.append(job.next_run_time.strftime("%H:%M"))
             
             return sorted(next_times)
             
@@ -332,9 +533,9 @@ class OptimizedNotificationScheduler:
         """Перепланируем уведомления"""
         try:
             # Удаляем старые задачи рассылок
-            for job in self.scheduler.get_jobs():
-                if job.id.startswith("daily_notification"):
-                    job.remove()
+            for job in self._daily_jobs():
+                job.remove()
+            self._daily_job_ids.clear()
             
             # Планируем заново
             self.schedule_daily_notifications()
@@ -348,7 +549,7 @@ class OptimizedNotificationScheduler:
         """Получаем статистику планировщика"""
         return {
             "total_notifications": self.notification_count,
-            "scheduled_jobs": len([j for j in self.scheduler.get_jobs() if j.id.startswith("daily_notification")]),
+            "scheduled_jobs": len(self._daily_jobs()),
             "is_running": self.scheduler.running,
             "is_sending": self.is_sending,
             "total_sent": self.stats['total_sent'],
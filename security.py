@@ -4,21 +4,45 @@ import json
 import logging
 import os
 import re
-from datetime import datetime, timedelta
-from typing import Dict, Set, List
-from collections import defaultdict
+import time
+from datetime import datetime
+from functools import wraps
+from typing import Deque, Dict, Set, List
+from collections import deque
+
+from config import ADMIN_ID
+
+try:
+    import ahocorasick  # pyahocorasick, опционально
+except ImportError:
+    ahocorasick = None
 
 logger = logging.getLogger(__name__)
 
 # Файлы для хранения данных безопасности
 SECURITY_DATA_FILE = "data/security.json"
+# Журнал блокировок: строка "id" - блокировка, "-id" - разблокировка
 BLOCKED_USERS_FILE = "data/blocked_users.txt"
 
+# Лимиты действий: тип -> (ключ в rate_limits, окно в секундах, описание для лога)
+ACTION_RATE_LIMITS = {
+    'message': ('messages_per_hour', 60 * 60, 'сообщений в час'),
+    'phrase': ('phrases_per_day', 24 * 60 * 60, 'фраз в день'),
+    'command': ('commands_per_minute', 60, 'команд в минуту'),
+}
+# Для действий без лимита историю храним неделю
+DEFAULT_ACTION_WINDOW = 7 * 24 * 60 * 60
+# Как часто вычищаем пользователей, у которых все действия устарели
+ACTION_SWEEP_INTERVAL = 60 * 60
+
 class SecurityManager:
     """Менеджер безопасности бота"""
     
     def __init__(self):
-        self.user_actions = defaultdict(list)  # История действий пользователей
+        # История действий: user_id -> тип действия -> время (time.monotonic) по возрастанию
+        self.user_actions: Dict[int, Dict[str, Deque[float]]] = {}
+        self._next_actions_sweep = time.monotonic() + ACTION_SWEEP_INTERVAL
+        # Множество меняется только на месте: обработчики держат ссылку на него
         self.blocked_users = set()
         self.suspicious_patterns = []
         self.rate_limits = {
@@ -49,6 +73,29 @@ class SecurityManager:
             r'деньги|доход|заработ|млн|тысяч',
             r'телеграм[- ]?канал|подписыва',
         ]
+        
+        # Рекламные паттерны - это просто наборы подстрок: их раскрытие для автомата
+        pattern_words = {
+            r'куп[иы]|продаж|скидк|акция|реклам': ('купи', 'купы', 'продаж', 'скидк', 'акция', 'реклам'),
+            r'деньги|доход|заработ|млн|тысяч': ('деньги', 'доход', 'заработ', 'млн', 'тысяч'),
+            r'телеграм[- ]?канал|подписыва': ('телеграм-канал', 'телеграм канал', 'телеграмканал', 'подписыва'),
+        }
+        
+        # С pyahocorasick все рекламные слова ищутся одним автоматом, регулярки - только для остального
+        self._words_automaton = None
+        regex_patterns = self.suspicious_patterns
+        if ahocorasick is not None:
+            self._words_automaton = ahocorasick.Automaton()
+            for pattern, words in pattern_words.items():
+                for word in words:
+                    self._words_automaton.add_word(word, pattern)
+            self._words_automaton.make_automaton()
+            regex_patterns = [pattern for pattern in self.suspicious_patterns if pattern not in pattern_words]
+        
+        # Компилируем один раз. Объединенное выражение - быстрая проверка чистого текста
+        # за один проход; обратная ссылка \1 верна, пока паттерн с группой идет первым
+        self._suspicious_regexes = [(pattern, re.compile(pattern)) for pattern in regex_patterns]
+        self._suspicious_any_re = re.compile('|'.join(f'(?:{pattern})' for pattern in regex_patterns))
     
     def load_security_data(self):
         """Загружаем данные безопасности"""
@@ -78,21 +125,39 @@ class SecurityManager:
             logger.error(f"❌ Ошибка сохранения данных безопасности: {e}")
     
     def load_blocked_users(self):
-        """Загружаем список заблокированных пользователей"""
+        """Загружаем список заблокированных пользователей (проигрываем журнал)"""
         try:
             if os.path.exists(BLOCKED_USERS_FILE):
+                records = 0
                 with open(BLOCKED_USERS_FILE, 'r', encoding='utf-8') as f:
                     for line in f:
                         user_id = line.strip()
                         if user_id.isdigit():
                             self.blocked_users.add(int(user_id))
+                            records += 1
+                        elif user_id.startswith('-') and user_id[1:].isdigit():
+                            self.blocked_users.discard(int(user_id[1:]))
+                            records += 1
+                
+                # В журнале накопились разблокировки или повторы - сжимаем
+                if records > len(self.blocked_users):
+                    self.save_blocked_users()
                 
                 logger.info(f"🚫 Загружено {len(self.blocked_users)} заблокированных пользователей")
         except Exception as e:
             logger.error(f"❌ Ошибка загрузки заблокированных пользователей: {e}")
     
+    def _append_blocked_record(self, record: str):
+        """Дописываем одну запись в журнал блокировок"""
+        try:
+            os.makedirs("data", exist_ok=True)
+            with open(BLOCKED_USERS_FILE, 'a', encoding='utf-8') as f:
+                f.write(f"{record}\n")
+        except Exception as e:
+            logger.error(f"❌ Ошибка записи в журнал блокировок: {e}")
+    
     def save_blocked_users(self):
-        """Сохраняем список заблокированных пользователей"""
+        """Сохраняем список заблокированных пользователей целиком (сжатие журнала)"""
         try:
             os.makedirs("data", exist_ok=True)
             with open(BLOCKED_USERS_FILE, 'w', encoding='utf-8') as f:
@@ -107,78 +172,100 @@ class SecurityManager:
     
     def block_user(self, user_id: int, reason: str = "Spam"):
         """Блокируем пользователя"""
-        self.blocked_users.add(user_id)
-        self.save_blocked_users()
+        if user_id not in self.blocked_users:
+            self.blocked_users.add(user_id)
+            self._append_blocked_record(str(user_id))
         logger.warning(f"🚫 Заблокирован пользователь {user_id}: {reason}")
     
     def unblock_user(self, user_id: int):
         """Разблокируем пользователя"""
-        self.blocked_users.discard(user_id)
-        self.save_blocked_users()
+        if user_id in self.blocked_users:
+            self.blocked_users.discard(user_id)
+            self._append_blocked_record(f"-{user_id}")
         logger.info(f"✅ Разблокирован пользователь {user_id}")
     
+    @staticmethod
+    def _expire_actions(actions: Deque[float], action_type: str, now: float):
+        """Отбрасываем с начала действия старше окна этого типа"""
+        rule = ACTION_RATE_LIMITS.get(action_type)
+        cutoff = now - (rule[1] if rule else DEFAULT_ACTION_WINDOW)
+        while actions and actions[0] <= cutoff:
+            actions.popleft()
+    
+    def _sweep_user_actions(self, now: float):
+        """Удаляем пользователей, у которых не осталось действий в пределах окон"""
+        for user_id in list(self.user_actions):
+            user_actions = self.user_actions[user_id]
+            for action_type, actions in list(user_actions.items()):
+                self._expire_actions(actions, action_type, now)
+                if not actions:
+                    del user_actions[action_type]
+            if not user_actions:
+                del self.user_actions[user_id]
+    
     def check_rate_limit(self, user_id: int, action_type: str) -> bool:
         """Проверяем не превышает ли пользователь лимиты"""
-        now = datetime.now()
-        user_actions = self.user_actions[user_id]
-        
-        # Очищаем старые действия
-        if action_type == 'message':
-            # Лимит сообщений в час
-            cutoff = now - timedelta(hours=1)
-            recent_messages = [a for a in user_actions if a['type'] == 'message' and a['time'] > cutoff]
-            
-            if len(recent_messages) >= self.rate_limits['messages_per_hour']:
-                logger.warning(f"⚠️ Пользователь {user_id} превысил лимит сообщений в час")
-                return False
-        
-        elif action_type == 'phrase':
-            # Лимит фраз в день
-            cutoff = now - timedelta(days=1)
-            recent_phrases = [a for a in user_actions if a['type'] == 'phrase' and a['time'] > cutoff]
-            
-            if len(recent_phrases) >= self.rate_limits['phrases_per_day']:
-                logger.warning(f"⚠️ Пользователь {user_id} превысил лимит фраз в день")
-                return False
-        
-        elif action_type == 'command':
-            # Лимит команд в минуту
-            cutoff = now - timedelta(minutes=1)
-            recent_commands = [a for a in user_actions if a['type'] == 'command' and a['time'] > cutoff]
-            
-            if len(recent_commands) >= self.rate_limits['commands_per_minute']:
-                logger.warning(f"⚠️ Пользователь {user_id} превысил лимит команд в минуту")
-                return False
+        rule = ACTION_RATE_LIMITS.get(action_type)
+        if rule is None:
+            return True
+        
+        user_actions = self.user_actions.get(user_id)
+        actions = user_actions.get(action_type) if user_actions else None
+        if not actions:
+            return True
+        
+        self._expire_actions(actions, action_type, time.monotonic())
+        if not actions:
+            del user_actions[action_type]
+            if not user_actions:
+                del self.user_actions[user_id]
+            return True
+        
+        limit_key, _, description = rule
+        if len(actions) >= self.rate_limits[limit_key]:
+            logger.warning("⚠️ Пользователь %s превысил лимит %s", user_id, description)
+            return False
         
         return True
     
     def log_user_action(self, user_id: int, action_type: str, content: str = ""):
-        """Логируем действие пользователя"""
-        action = {
-            'type': action_type,
-            'time': datetime.now(),
-            'content': content[:100]  # Ограничиваем длину
-        }
+        """Логируем действие пользователя (для лимитов важно только время)"""
+        now = time.monotonic()
+        if now >= self._next_actions_sweep:
+            self._next_actions_sweep = now + ACTION_SWEEP_INTERVAL
+            self._sweep_user_actions(now)
         
-        self.user_actions[user_id].append(action)
-        
-        # Очищаем старые действия (оставляем только за последние 7 дней)
-        cutoff = datetime.now() - timedelta(days=7)
-        self.user_actions[user_id] = [
-            a for a in self.user_actions[user_id] if a['time'] > cutoff
-        ]
+        user_actions = self.user_actions.setdefault(user_id, {})
+        actions = user_actions.get(action_type)
+        if actions is None:
+            # Для лимита важно только len() >= limit, поэтому больше limit записей не храним
+            rule = ACTION_RATE_LIMITS.get(action_type)
+            maxlen = self.rate_limits[rule[0]] if rule else None
+            actions = user_actions[action_type] = deque(maxlen=maxlen)
+        else:
+            self._expire_actions(actions, action_type, now)
+        actions.append(now)
     
     def check_suspicious_content(self, text: str) -> List[str]:
         """Проверяем содержимое на подозрительные паттерны"""
-        found_patterns = []
         text_lower = text.lower()
+        found = set()
+        
+        if self._words_automaton is not None:
+            found.update(pattern for _, pattern in self._words_automaton.iter(text_lower))
+        
+        # Обычно текст чистый - хватает одного прохода; иначе уточняем, какие паттерны совпали
+        if self._suspicious_any_re.search(text_lower) is not None:
+            found.update(pattern for pattern, regex in self._suspicious_regexes if regex.search(text_lower))
         
-        for pattern in self.suspicious_patterns:
-            if re.search(pattern, text_lower):
-                found_patterns.append(pattern)
+        if not found:
+            return []
+        
+        # Порядок - как в suspicious_patterns
+        found_patterns = [pattern for pattern in self.suspicious_patterns if pattern in found]
         
         if found_patterns:
-            logger.warning(f"🔍 Найдены подозрительные паттерны в тексте: {found_patterns}")
+            logger.warning("🔍 Найдены подозрительные паттерны в тексте: %s", found_patterns)
         
         return found_patterns
     
@@ -236,5 +323,20 @@ class SecurityManager:
             'suspicious_patterns_count': len(self.suspicious_patterns)
         }
 
+# Ответ на попытку вызвать админскую команду без прав
+NO_ACCESS_MESSAGE = "У вас нет доступа к этой команде."
+
+def admin_only(handler):
+    """Декоратор: пропускает к обработчику только администратора"""
+    @wraps(handler)
+    async def wrapper(update, context):
+        user = update.effective_user
+        if user.id != ADMIN_ID:
+            logger.warning(f"🚫 Не-админ {user.first_name} (ID: {user.id}) вызвал {handler.__name__}")
+            await update.message.reply_text(NO_ACCESS_MESSAGE)
+            return
+        return await handler(update, context, user)
+    return wrapper
+
 # Глобальный экземпляр менеджера безопасности
 security_manager = SecurityManager()
\ No newline at end of file